@@ -8,8 +8,11 @@ __license__ = 'LGPL'
 
 from facets import *
 from hits import *
+from excerpts import *
 from queries import *
+from rewriters import *
 from sphinx import *
 from cache import *
 from pretty_url import *
+from pool import *
 import utils
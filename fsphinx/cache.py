@@ -1,16 +1,253 @@
 """This module adds caching to Sphinx."""
 
-__all__ = ['RedisCache', 'CacheSphinx', 'CacheIO']
+__all__ = ['CacheBackend', 'RedisCache', 'LocalCache', 'MMapCache', 'SingleFlight', 'CacheSphinx',
+           'CacheIO', 'JSONSerializer', 'MarshalSerializer', 'PickleSerializer', 'MsgpackSerializer',
+           'IndexGeneration']
 
 import redis
+import copy
+import fcntl
 import hashlib
+import itertools
+import logging
+import marshal
+import mmap
+import os
+import sys
+import threading
+from struct import pack, unpack
+import time
+import uuid
+import zlib
+import cPickle as pickle
 import simplejson as json
 
+import utils
 from sphinxapi import SphinxClient
 
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 
-class RedisCache(object):
+try:
+    import lz4.block as lz4
+except ImportError:
+    lz4 = None
+
+log = logging.getLogger('fsphinx')
+log.addHandler(logging.NullHandler())
+
+# first byte of the values stored in the cache (older values are plain JSON)
+CACHE_VERSION = '\x02'
+
+# header of the files written by RedisCache.Dumps
+DUMP_MAGIC = 'FSPHINX-DUMP\x01'
+
+# header of the files mapped by MMapCache
+MMAP_MAGIC = 'FSPHINX-MMAP\x01'
+
+# taken by the processes reopening a MMapCache after a fork
+_fork_lock = threading.Lock()
+
+
+class JSONSerializer(object):
+    """Serializes the cached values to JSON.
+    """
+    id = 'j'
+
+    def Dumps(self, value):
+        return json.dumps(value)
+
+    def Loads(self, s):
+        return json.loads(s)
+
+
+class MarshalSerializer(object):
+    """Serializes the cached values with marshal.
+
+    This is the fastest but only plain dicts, lists and scalars can be cached.
+    """
+    id = 'm'
+
+    def Dumps(self, value):
+        return marshal.dumps(value)
+
+    def Loads(self, s):
+        return marshal.loads(s)
+
+
+class PickleSerializer(object):
+    """Serializes the cached values with pickle protocol 2.
+    """
+    id = 'p'
+
+    def Dumps(self, value):
+        return pickle.dumps(value, 2)
+
+    def Loads(self, s):
+        return pickle.loads(s)
+
+
+class MsgpackSerializer(object):
+    """Serializes the cached values with msgpack which must be installed.
+    """
+    id = 'M'
+
+    def __init__(self):
+        if not msgpack:
+            raise ImportError('msgpack is required by MsgpackSerializer')
+
+    def Dumps(self, value):
+        return msgpack.packb(value, use_bin_type=True)
+
+    def Loads(self, s):
+        return msgpack.unpackb(s, raw=False)
+
+
+SERIALIZERS = dict((cls.id, cls) for cls in
+    [JSONSerializer, MarshalSerializer, PickleSerializer, MsgpackSerializer])
+
+# name -> (id, compress, decompress)
+COMPRESSORS = {'zlib': ('z', zlib.compress, zlib.decompress)}
+if lz4:
+    COMPRESSORS['lz4'] = ('l', lz4.compress, lz4.decompress)
+DECOMPRESSORS = dict((id, decompress) for id, _, decompress in COMPRESSORS.values())
+
+
+class CacheBackend(object):
+    """The interface of the caches which can be attached to a fSphinx client.
+
+    A backend must implement MGetAged, MSet, MDelete and Flush. The keys are
+    any repr-able object and the values are the results of Sphinx. The values
+    may be stored under the keys made by _MakeKey.
+
+    The cache is looked up with MGetAged which returns (value, age) pairs, with
+    (None, None) for the missing keys. MSet takes the expire in sec. of the
+    keys with 0 for the default expire of the backend and -1 for no expire.
+    """
+    def _MakeKey(self, key):
+        if not isinstance(key, basestring):
+            key = repr(key)
+        return hashlib.md5(key).hexdigest()
+
+    def _Dumps(self, value):
+        """Used internally by the backends storing the values as strings.
+        """
+        s = self.serializer.Dumps(value)
+        compress = '-'
+        if self.compress and len(s) >= self.compress_min:
+            compress, func, _ = COMPRESSORS[self.compress]
+            s = func(s)
+        return CACHE_VERSION + self.serializer.id + compress + pack('>d', time.time()) + s
+
+    def _Loads(self, s):
+        """Returns the value and the time it was set (None if unknown).
+        """
+        if s[0] == CACHE_VERSION:
+            serializer, compress = s[1], s[2]
+            created, s = unpack('>d', s[3:11])[0], s[11:]
+        elif s[0] == '\x01':
+            serializer, compress, s = s[1], s[2], s[3:]
+            created = None
+        else:
+            return json.loads(s), None
+        if compress != '-':
+            s = DECOMPRESSORS[compress](s)
+        if serializer == self.serializer.id:
+            return self.serializer.Loads(s), created
+        return SERIALIZERS[serializer]().Loads(s), created
+
+    def Set(self, key, value, expire=0, _raw=False):
+        self.MSet([(key, value)], expire, _raw)
+
+    def MSet(self, items, expire=0, _raw=False):
+        raise NotImplementedError
+
+    def Get(self, key):
+        return self.MGet([key])[0]
+
+    def MGet(self, keys):
+        """Get the values of many keys at once.
+
+        The value of a key not found in the cache is None.
+        """
+        return [value for value, _ in self.MGetAged(keys)]
+
+    def MGetAged(self, keys):
+        raise NotImplementedError
+
+    def GetSet(self, key, func):
+        val = self.Get(key)
+        if val is None:
+            val = _Coalesce(self, [key], lambda keys: [func()])[0]
+        return val
+
+    def Delete(self, key):
+        self.MDelete([key])
+
+    def MDelete(self, keys):
+        raise NotImplementedError
+
+    def Lock(self, key):
+        """Take a lock on a key to compute it once with single flight.
+
+        By default only the threads of the same process are coalesced.
+        """
+        return True
+
+    def Unlock(self, key, token):
+        pass
+
+    def Wait(self, keys, timeout):
+        """Wait up to timeout sec. for the keys to be set by another process.
+
+        The value of a key which has not been set in time is None.
+        """
+        deadline = time.time() + timeout
+        values = self.MGet(keys)
+        while None in values and time.time() < deadline:
+            time.sleep(0.05)
+            missing = [i for i, value in enumerate(values) if value is None]
+            for i, value in zip(missing, self.MGet([keys[i] for i in missing])):
+                values[i] = value
+        return values
+
+    def Flush(self):
+        raise NotImplementedError
+
+    def __contains__(self, key):
+        return self.Get(key) is not None
+
+
+class RedisCache(CacheBackend):
     """Creates a cache using Redis which can be attached to a fSphinx client.
+
+    The values are serialized to JSON unless another serializer is passed.
+    They may also be compressed with zlib or lz4 if they are large enough:
+
+    # let's use pickle and compress the values larger than 1KB
+    cache = RedisCache(db=0, serializer=PickleSerializer(), compress='zlib', compress_min=1024)
+
+    With single_flight=True, concurrent computations of the same missing key are
+    coalesced. Within a process the threads wait for the one computing the key.
+    Across processes a lock which expires after lock_expire sec. is taken, and the
+    other processes wait up to lock_wait sec. before computing the key themselves.
+
+    With soft_expire set, a value older than soft_expire sec. is still served by
+    CacheSphinx but it is recomputed in the background by one of refresh_workers
+    threads. The value is removed by Redis after expire sec.
+
+    The keys are namespaced by an index generation so that a reindex does not
+    require flushing the cache. The generation is either set explicitly or
+    computed from the index files found in index_paths every generation_check
+    sec. With track_usage=True, the most used requests of a generation can be
+    re-run in the next one with WarmUp. The usage is sent to Redis at most every
+    track_flush sec., only the track_max most used requests are kept and they are
+    removed after track_expire sec. without use:
+
+    # let's switch to a new namespace whenever the items index is rotated
+    cache = RedisCache(db=0, index_paths=['./data/sph-index/items'], track_usage=True)
     """
     def __init__(self, **kwargs):
         # default is 200MB
@@ -21,6 +258,43 @@ class RedisCache(object):
         self.maxmemory_samples = kwargs.pop('maxmemory_samples', 3)
         # expire on new keys default is we let maxmemory-policy do the job
         self.expire = kwargs.pop('expire', 10 ** 10)
+        # serialization and compression of the values
+        self.serializer = kwargs.pop('serializer', JSONSerializer())
+        self.compress = kwargs.pop('compress', None)
+        self.compress_min = kwargs.pop('compress_min', 1024)
+        if self.compress and self.compress not in COMPRESSORS:
+            raise ValueError('unknown compression %s' % self.compress)
+        # coalescing of concurrent computations of the same keys
+        self.flights = kwargs.pop('single_flight', False) and SingleFlight() or None
+        self.lock_expire = kwargs.pop('lock_expire', 10)
+        self.lock_wait = kwargs.pop('lock_wait', 5)
+        # stale while revalidate
+        self.soft_expire = kwargs.pop('soft_expire', 0)
+        self.refresh_workers = kwargs.pop('refresh_workers', 2)
+        self.refreshes = 0
+        self.stale_hits = 0
+        self.stale_age = 0
+        self.max_stale_age = 0
+        self._refreshing = set()
+        self._refresh_pool = None
+        self._refresh_lock = threading.Lock()
+        # index generation of the keys
+        self.generation = kwargs.pop('generation', '')
+        self.previous_generation = None
+        self.index_paths = kwargs.pop('index_paths', [])
+        self.generation_check = kwargs.pop('generation_check', 10)
+        self.track_usage = kwargs.pop('track_usage', False)
+        self.track_flush = kwargs.pop('track_flush', 10)
+        self.track_max = kwargs.pop('track_max', 1000)
+        self.track_expire = kwargs.pop('track_expire', 7 * 24 * 3600)
+        self._tracked = {}
+        self._tracked_at = time.time()
+        self._track_lock = threading.Lock()
+        self._generation_checked = 0
+        if self.index_paths:
+            # fails early if the index files cannot be found
+            self.SetGeneration(IndexGeneration(*self.index_paths))
+            self._generation_checked = time.time()
         # initialize redis cache
         self.c = redis.StrictRedis(**kwargs)
         self.c.config_set('maxmemory', self.maxmemory)
@@ -30,45 +304,284 @@ class RedisCache(object):
     def _MakeKey(self, key):
         if not isinstance(key, basestring):
             key = repr(key)
-        return hashlib.md5(key).hexdigest()
+        key = hashlib.md5(key).hexdigest()
+        if self.index_paths:
+            self._CheckGeneration()
+        if self.generation:
+            key = '%s:%s' % (self.generation, key)
+        return key
 
-    def Set(self, key, value, expire=0, _raw=False):
-        if not _raw:
-            key = self._MakeKey(key)
-            value = json.dumps(value)
-        self.c.set(key, value)
+    def SetGeneration(self, generation):
+        """Set the index generation which namespaces all the keys.
+
+        The entries of the previous generation are not deleted but left to expire.
+        """
+        if generation != self.generation:
+            self.previous_generation = self.generation
+            self.generation = generation
+
+    def _CheckGeneration(self):
+        """Used internally to update the generation from the index files.
+        """
+        now = time.time()
+        if now - self._generation_checked > self.generation_check:
+            self._generation_checked = now
+            try:
+                self.SetGeneration(IndexGeneration(*self.index_paths))
+            except OSError, e:
+                # the index files may be missing while they are rotated
+                log.warning('keeping the cache generation %s: %s', self.generation, e)
+
+    def Track(self, keys, reqs):
+        """Count the use of the keys of Sphinx requests in this generation.
+
+        The counts are kept in memory and sent to Redis every track_flush sec.
+        """
+        self._track_lock.acquire()
+        try:
+            for key, req in zip(keys, reqs):
+                mkey = self._MakeKey(key)
+                entry = self._tracked.get((self.generation, mkey))
+                if entry:
+                    entry[0] += 1
+                else:
+                    self._tracked[(self.generation, mkey)] = [1, key, req]
+            if time.time() - self._tracked_at < self.track_flush:
+                return
+        finally:
+            self._track_lock.release()
+        self.FlushUsage()
 
+    def FlushUsage(self):
+        """Send the usage counted by Track to Redis in one round trip.
+        """
+        self._track_lock.acquire()
+        try:
+            tracked, self._tracked, self._tracked_at = self._tracked, {}, time.time()
+        finally:
+            self._track_lock.release()
+        if not tracked:
+            return
+        pipe = self.c.pipeline(transaction=False)
+        for (generation, mkey), (count, key, req) in tracked.items():
+            pipe.zincrby('usage:%s' % generation, value=mkey, amount=count)
+            pipe.set('reqs:%s:%s' % (generation, mkey), pickle.dumps((key, req), 2),
+                     ex=self.track_expire)
+        for generation in set(generation for generation, _ in tracked):
+            usage = 'usage:%s' % generation
+            pipe.zremrangebyrank(usage, 0, -self.track_max - 1)
+            pipe.expire(usage, self.track_expire)
+        pipe.execute()
+
+    def WarmUp(self, cl, generation=None, n=100, batch=20):
+        """Re-run in the current generation the n most used requests of another
+        generation (defaults to the previous one) using the Sphinx client cl.
+
+        Returns the number of requests which have been re-run.
+        """
+        if generation is None:
+            generation = self.previous_generation
+        if generation is None or generation == self.generation:
+            return 0
+        self.FlushUsage()
+        mkeys = self.c.zrevrange('usage:%s' % generation, 0, n - 1)
+        if not mkeys:
+            return 0
+        saved = [pickle.loads(s) for s in
+                 self.c.mget(['reqs:%s:%s' % (generation, mkey) for mkey in mkeys]) if s]
+        for group in utils.group(saved, batch):
+            cl._reqs = [req for _, req in group]
+            if hasattr(cl, '_req_keys'):
+                cl._req_keys = [key for key, _ in group]
+            CacheSphinx(self, cl)
+        return len(saved)
+
+    def MSet(self, items, expire=0, _raw=False):
+        """Set many (key, value) pairs in one pipelined transaction.
+        """
+        if not items:
+            return
         expire = expire or self.expire
-        if expire == -1:
-            self.c.persist(key)
-        else:
-            self.c.expire(key, expire)
+        pipe = self.c.pipeline(transaction=True)
+        for key, value in items:
+            if not _raw:
+                key = self._MakeKey(key)
+                value = self._Dumps(value)
+            # a plain SET also removes any previous expire
+            if expire == -1:
+                pipe.set(key, value)
+            else:
+                pipe.set(key, value, ex=expire)
+        pipe.execute()
 
-    def Get(self, key):
-        value = self.c.get(self._MakeKey(key))
-        if value:
-            value = json.loads(value)
-        return value
+    def MGetAged(self, keys):
+        """Get the values of many keys at once with their age in sec.
 
-    def GetSet(self, key, func):
-        if key in self:
-            val = self.Get(key)
-        else:
-            val = func()
-            self.Set(key, val)
-        return val
+        Returns a list of (value, age) pairs which are (None, None) for the keys
+        not found in the cache.
+        """
+        if not keys:
+            return []
+        now = time.time()
+        values = []
+        for s in self.c.mget([self._MakeKey(key) for key in keys]):
+            if not s:
+                values.append((None, None))
+            else:
+                value, created = self._Loads(s)
+                values.append((value, created and max(0, now - created) or 0))
+        return values
+
+    def MDelete(self, keys):
+        if keys:
+            self.c.delete(*[self._MakeKey(key) for key in keys])
+
+    def Lock(self, key):
+        """Take a lock on a key for lock_expire sec.
+
+        Returns a token to release the lock or None if the lock is already taken.
+        """
+        token = uuid.uuid4().hex
+        if self.c.set('lock:' + self._MakeKey(key), token, nx=True, px=int(self.lock_expire * 1000)):
+            return token
+
+    def Unlock(self, key, token):
+        """Release a lock on a key unless it has expired and been taken again.
+        """
+        lock = 'lock:' + self._MakeKey(key)
+        pipe = self.c.pipeline(transaction=True)
+        try:
+            pipe.watch(lock)
+            if pipe.get(lock) == token:
+                pipe.multi()
+                pipe.delete(lock)
+                pipe.execute()
+        except redis.WatchError:
+            pass
+        finally:
+            pipe.reset()
+
+    def Refresh(self, keys, compute, cache=None):
+        """Schedule one background recomputation of each of the keys.
 
-    def Dumps(self, to_file):
-        to_file = open(to_file, 'w')
-        for k in self.c.keys('*'):
-            to_file.write('%s@@@@@%s\n' % (k, self.c.get(k)))
+        The function compute takes a list of keys and returns their values which
+        are then set in cache (defaults to this cache).
+        """
+        mkeys = [self._MakeKey(key) for key in keys]
+        self._refresh_lock.acquire()
+        try:
+            keys = [key for key, mkey in zip(keys, mkeys) if mkey not in self._refreshing]
+            mkeys = [mkey for mkey in mkeys if mkey not in self._refreshing]
+            self._refreshing.update(mkeys)
+            if keys and not self._refresh_pool:
+                from multiprocessing.pool import ThreadPool
+                self._refresh_pool = ThreadPool(self.refresh_workers)
+        finally:
+            self._refresh_lock.release()
+        if keys:
+            self._refresh_pool.apply_async(self._Refresh, (keys, mkeys, compute, cache or self))
 
-    def Loads(self, from_file, expire=0):
-        for l in open(from_file):
-            if '@@@@@' not in l:
-                print 'Warning: skipping %s' % l
-            k, v = l.split('@@@@@')
-            self.Set(k, v, expire, _raw=True)
+    def _Refresh(self, keys, mkeys, compute, cache):
+        """Used internally to recompute keys in a background thread.
+        """
+        tokens = {}
+        try:
+            # with single flight only one process refreshes a key
+            if self.flights:
+                for key in keys:
+                    tokens[key] = self.Lock(key)
+                keys = [key for key in keys if tokens[key]]
+            if keys:
+                values = compute(keys)
+                if values != None:
+                    cache.MSet([(key, value) for key, value in zip(keys, values) if value != None])
+                    self._refresh_lock.acquire()
+                    try:
+                        self.refreshes += len(keys)
+                    finally:
+                        self._refresh_lock.release()
+        finally:
+            for key, token in tokens.items():
+                if token:
+                    self.Unlock(key, token)
+            self._refresh_lock.acquire()
+            try:
+                self._refreshing.difference_update(mkeys)
+            finally:
+                self._refresh_lock.release()
+
+    def _ServeStale(self, age):
+        """Used internally to keep track of the age of the stale values served.
+        """
+        self.stale_hits += 1
+        self.stale_age = age
+        self.max_stale_age = max(self.max_stale_age, age)
+
+    def Dumps(self, to_file, batch=1000, progress=None):
+        """Dump all the keys of the cache with their expire into a file.
+
+        The keys are scanned and read in pipelined batches so that Redis is never
+        blocked. If given, progress is called with the number of keys dumped so far.
+        Returns the number of keys dumped.
+        """
+        to_file = open(to_file, 'wb')
+        to_file.write(DUMP_MAGIC)
+        count = 0
+        try:
+            for keys in _Batches(self.c.scan_iter(count=batch), batch):
+                pipe = self.c.pipeline(transaction=False)
+                for k in keys:
+                    pipe.get(k)
+                    pipe.pttl(k)
+                # keys which are not strings (usage counts, locks ...) make GET fail
+                res = pipe.execute(raise_on_error=False)
+                for k, v, pttl in zip(keys, res[::2], res[1::2]):
+                    if not isinstance(v, str) or k.startswith(('lock:', 'reqs:')) or pttl == -2:
+                        continue
+                    to_file.write(pack('>IIq', len(k), len(v), pttl))
+                    to_file.write(k)
+                    to_file.write(v)
+                    count += 1
+                if progress:
+                    progress(count)
+        finally:
+            to_file.close()
+        return count
+
+    def Loads(self, from_file, expire=None, batch=1000, progress=None):
+        """Load the keys dumped into a file in pipelined batches.
+
+        The keys keep their dumped expire unless expire is set, with -1 for no
+        expire. Files dumped in the older text format are also read. If given,
+        progress is called with the number of keys loaded so far. Returns the
+        number of keys loaded.
+        """
+        from_file = open(from_file, 'rb')
+        try:
+            if from_file.read(len(DUMP_MAGIC)) != DUMP_MAGIC:
+                from_file.seek(0)
+                records = _ReadTextDump(from_file)
+            else:
+                records = _ReadDump(from_file)
+            count = 0
+            for items in _Batches(records, batch):
+                pipe = self.c.pipeline(transaction=False)
+                for k, v, pttl in items:
+                    # expire in ms. with -1 for no expire
+                    if pttl is None or expire:
+                        pttl = expire or self.expire
+                        pttl = pttl == -1 and -1 or pttl * 1000
+                    if pttl == -1:
+                        pipe.set(k, v)
+                    elif pttl > 0:
+                        pipe.set(k, v, px=pttl)
+                pipe.execute()
+                count += len(items)
+                if progress:
+                    progress(count)
+        finally:
+            from_file.close()
+        return count
 
     def Flush(self):
         self.c.flushdb()
@@ -77,55 +590,658 @@ class RedisCache(object):
         return self.c.exists(self._MakeKey(key))
 
 
+class LocalCache(CacheBackend):
+    """Creates a bounded in-process cache with LRU eviction which may be put in
+    front of another cache such as a RedisCache.
+
+    The values are kept already deserialized and the misses are looked up in the
+    cache behind if there is one.
+
+    # let's keep up to 50MB of results for 60 sec. in each process
+    cache = LocalCache(RedisCache(db=0), maxbytes=1024 * 1024 * 50, ttl=60)
+
+    maxbytes: approximate maximum size in bytes of the values (defaults to 50MB).
+    ttl: time to live in sec. of each value (defaults to 60).
+    """
+    def __init__(self, cache=None, maxbytes=1024 * 1024 * 50, ttl=60):
+        self.cache = cache
+        self.maxbytes = maxbytes
+        self.ttl = ttl
+        # hit and miss counters of the local cache
+        self.hits = 0
+        self.misses = 0
+        self._values = utils.OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def _MakeKey(self, key):
+        if self.cache:
+            return self.cache._MakeKey(key)
+        if not isinstance(key, basestring):
+            key = repr(key)
+        return hashlib.md5(key).hexdigest()
+
+    @property
+    def expire(self):
+        """The expire of the keys set in the cache behind.
+        """
+        return self.cache.expire
+
+    @expire.setter
+    def expire(self, expire):
+        self.cache.expire = expire
+
+    def MSet(self, items, expire=0, _raw=False):
+        """Set many (key, value) pairs locally and in the cache behind.
+
+        The expire parameter only applies to the cache behind.
+        """
+        if not _raw:
+            now = time.time()
+            self._Store((self._MakeKey(key), value, now) for key, value in items)
+        if self.cache:
+            self.cache.MSet(items, expire, _raw)
+
+    def MGetAged(self, keys):
+        """Get the values of many keys at once with their age in sec.
+
+        The keys not found locally are looked up at once in the cache behind.
+        The age of a value is counted from when it was set in the cache behind.
+        """
+        keys = list(keys)
+        mkeys = [self._MakeKey(key) for key in keys]
+        now = time.time()
+        values = [(None, None)] * len(keys)
+        self._lock.acquire()
+        try:
+            for i, mkey in enumerate(mkeys):
+                entry = self._values.pop(mkey, None)
+                if entry and entry[2] > now:
+                    self._values[mkey] = entry
+                    values[i] = (entry[0], now - entry[3])
+                elif entry:
+                    self._size -= entry[1]
+            missing = [i for i, (value, _) in enumerate(values) if value is None]
+            self.hits += len(keys) - len(missing)
+            self.misses += len(missing)
+        finally:
+            self._lock.release()
+
+        if missing and self.cache:
+            found = self.cache.MGetAged([keys[i] for i in missing])
+            self._Store((mkeys[i], value, now - age) for i, (value, age) in zip(missing, found)
+                        if value is not None)
+            for i, value in zip(missing, found):
+                values[i] = value
+        return [(_Copy(value), age) for value, age in values]
+
+    def Refresh(self, keys, compute, cache=None):
+        """Schedule a background recomputation of the keys in the cache behind.
+
+        The recomputed values are also set locally. Without a cache behind, the
+        keys are recomputed right away.
+        """
+        if self.cache:
+            self.cache.Refresh(keys, compute, cache or self)
+            return
+        values = compute(keys)
+        if values != None:
+            (cache or self).MSet([(key, value) for key, value in zip(keys, values) if value != None])
+
+    def MDelete(self, keys):
+        """Delete the keys locally and in the cache behind.
+        """
+        self._lock.acquire()
+        try:
+            for key in keys:
+                entry = self._values.pop(self._MakeKey(key), None)
+                if entry:
+                    self._size -= entry[1]
+        finally:
+            self._lock.release()
+        if self.cache:
+            self.cache.MDelete(keys)
+
+    def Lock(self, key):
+        if self.cache:
+            return self.cache.Lock(key)
+        return True
+
+    def Unlock(self, key, token):
+        if self.cache:
+            self.cache.Unlock(key, token)
+
+    def Wait(self, keys, timeout):
+        if self.cache:
+            return self.cache.Wait(keys, timeout)
+        return CacheBackend.Wait(self, keys, timeout)
+
+    def Invalidate(self):
+        """Empty the local cache only.
+        """
+        self._lock.acquire()
+        try:
+            self._values.clear()
+            self._size = 0
+        finally:
+            self._lock.release()
+
+    def Flush(self):
+        """Flush the cache behind and invalidate the local cache.
+        """
+        if self.cache:
+            self.cache.Flush()
+        self.Invalidate()
+
+    def _Store(self, items):
+        """Used internally to store a copy of the values and evict the least
+        recently used ones.
+        """
+        expire_at = time.time() + self.ttl
+        items = [(mkey, _Copy(value), born) for mkey, value, born in items]
+        self._lock.acquire()
+        try:
+            for mkey, value, born in items:
+                size = _SizeOf(value)
+                if size > self.maxbytes:
+                    continue
+                entry = self._values.pop(mkey, None)
+                if entry:
+                    self._size -= entry[1]
+                self._values[mkey] = (value, size, expire_at, born)
+                self._size += size
+            while self._size > self.maxbytes:
+                self._size -= self._values.popitem(last=False)[1][1]
+        finally:
+            self._lock.release()
+
+    def __getattr__(self, name):
+        # Dumps, Loads and so on are those of the cache behind
+        if name == 'cache' or not self.cache:
+            raise AttributeError(name)
+        return getattr(self.cache, name)
+
+
+class MMapCache(CacheBackend):
+    """Creates a cache in a memory mapped file which all the processes of a host
+    can share without a network hop or a Redis server.
+
+    The file is a table of slots of slot_size bytes. A key always goes in the
+    same slot which it takes over from any previous key, so the cache needs no
+    eviction policy. The values larger than a slot are not cached.
+
+    # let's share up to 128MB of results between the processes of this host
+    cache = MMapCache('/dev/shm/fsphinx.cache', size=1024 * 1024 * 128)
+
+    The values are serialized and compressed as in RedisCache. Reads and writes
+    are locked across processes with flock, each process opening the file again
+    after a fork. An existing file must have the given size.
+    """
+    # key digest, value length, expire time (0 for none)
+    _header = '>16sId'
+    _header_size = 28
+
+    def __init__(self, path, size=1024 * 1024 * 128, slot_size=8192, **kwargs):
+        self.path = path
+        self.slot_size = slot_size
+        self._offset = len(MMAP_MAGIC) + 8
+        self.nb_slots = (size - self._offset) // slot_size
+        self.expire = kwargs.pop('expire', 10 ** 10)
+        self.serializer = kwargs.pop('serializer', JSONSerializer())
+        self.compress = kwargs.pop('compress', None)
+        self.compress_min = kwargs.pop('compress_min', 1024)
+        if self.compress and self.compress not in COMPRESSORS:
+            raise ValueError('unknown compression %s' % self.compress)
+        self.flights = kwargs.pop('single_flight', False) and SingleFlight() or None
+        self.lock_wait = kwargs.pop('lock_wait', 5)
+        self._lock = threading.Lock()
+        self._Open(size)
+
+    def _Open(self, size):
+        """Used internally to map the file and to format it if needed.
+        """
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0644)
+        self._pid = os.getpid()
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            file_size = os.fstat(self._fd).st_size
+            if file_size in (0, size):
+                if not file_size:
+                    os.ftruncate(self._fd, size)
+                self._map = mmap.mmap(self._fd, size, mmap.MAP_SHARED)
+                header = MMAP_MAGIC + pack('>II', self.slot_size, self.nb_slots)
+                if self._map[:len(header)] != header:
+                    self._Clear()
+                    self._map[:len(header)] = header
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        # resizing a file mapped by other processes would crash them
+        if file_size not in (0, size):
+            os.close(self._fd)
+            raise ValueError('%s is %s bytes and not %s' % (self.path, file_size, size))
+
+    def _Slot(self, mkey):
+        """Used internally to get the digest of a key and the offset of its slot.
+        """
+        digest = hashlib.md5(mkey).digest()
+        return digest, self._offset + unpack('>Q', digest[:8])[0] % self.nb_slots * self.slot_size
+
+    def _Acquire(self, op):
+        if self._pid != os.getpid():
+            self._Reopen()
+        self._lock.acquire()
+        fcntl.flock(self._fd, op)
+
+    def _Reopen(self):
+        """Used internally by a forked process to have a file description of its
+        own since the flock of a shared one would not exclude the other processes.
+        """
+        _fork_lock.acquire()
+        try:
+            if self._pid != os.getpid():
+                fd = os.open(self.path, os.O_RDWR)
+                os.close(self._fd)
+                self._fd, self._lock, self._pid = fd, threading.Lock(), os.getpid()
+        finally:
+            _fork_lock.release()
+
+    def _Release(self):
+        fcntl.flock(self._fd, fcntl.LOCK_UN)
+        self._lock.release()
+
+    def MSet(self, items, expire=0, _raw=False):
+        """Set many (key, value) pairs in the slots of their keys.
+        """
+        expire = expire or self.expire
+        expire_at = expire != -1 and time.time() + expire or 0
+        slots, too_large = [], []
+        for key, value in items:
+            if not _raw:
+                key = self._MakeKey(key)
+                value = self._Dumps(value)
+            if len(value) + self._header_size <= self.slot_size:
+                slots.append(self._Slot(key) + (value,))
+            else:
+                too_large.append(self._Slot(key))
+        self._Acquire(fcntl.LOCK_EX)
+        try:
+            for digest, offset, value in slots:
+                end = offset + self._header_size + len(value)
+                self._map[offset:end] = pack(self._header, digest, len(value), expire_at) + value
+            # the previous value of a key must not be served anymore
+            for digest, offset in too_large:
+                if self._map[offset:offset + 16] == digest:
+                    self._map[offset:offset + 16] = '\0' * 16
+        finally:
+            self._Release()
+
+    def MGetAged(self, keys):
+        """Get the values of many keys at once with their age in sec.
+
+        Returns a list of (value, age) pairs which are (None, None) for the keys
+        not found in the cache.
+        """
+        slots = [self._Slot(self._MakeKey(key)) for key in keys]
+        found = []
+        self._Acquire(fcntl.LOCK_SH)
+        try:
+            for digest, offset in slots:
+                header = self._map[offset:offset + self._header_size]
+                slot_digest, length, expire_at = unpack(self._header, header)
+                if slot_digest == digest and length <= self.slot_size - self._header_size:
+                    start = offset + self._header_size
+                    found.append((self._map[start:start + length], expire_at))
+                else:
+                    found.append((None, 0))
+        finally:
+            self._Release()
+
+        now = time.time()
+        values = []
+        for s, expire_at in found:
+            if not s or (expire_at and expire_at < now):
+                values.append((None, None))
+                continue
+            try:
+                value, created = self._Loads(s)
+            except Exception:
+                # a torn or corrupted slot is a miss
+                values.append((None, None))
+            else:
+                values.append((value, created and max(0, now - created) or 0))
+        return values
+
+    def MDelete(self, keys):
+        slots = [self._Slot(self._MakeKey(key)) for key in keys]
+        self._Acquire(fcntl.LOCK_EX)
+        try:
+            for digest, offset in slots:
+                if self._map[offset:offset + 16] == digest:
+                    self._map[offset:offset + 16] = '\0' * 16
+        finally:
+            self._Release()
+
+    def Flush(self):
+        self._Acquire(fcntl.LOCK_EX)
+        try:
+            self._Clear()
+        finally:
+            self._Release()
+
+    def _Clear(self):
+        """Used internally to empty all the slots. Must be called with the lock held.
+        """
+        empty = '\0' * self._header_size
+        for i in xrange(self.nb_slots):
+            start = self._offset + i * self.slot_size
+            self._map[start:start + self._header_size] = empty
+
+    def Close(self):
+        self._map.close()
+        os.close(self._fd)
+
+
+def _Copy(value):
+    """Used internally to copy what fSphinx modifies in place in the results.
+    """
+    if isinstance(value, list):
+        return [_Copy(v) for v in value]
+    if isinstance(value, dict):
+        value = dict(value)
+        if isinstance(value.get('matches'), list):
+            value['matches'] = [dict(m) for m in value['matches']]
+    return value
+
+
+def _SizeOf(value):
+    """Used internally to estimate the size in bytes of a value.
+    """
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(_SizeOf(k) + _SizeOf(v) for k, v in value.iteritems())
+    elif isinstance(value, (list, tuple)):
+        size += sum(_SizeOf(v) for v in value)
+    return size
+
+
 def CacheSphinx(cache, cl):
     """Caches the request of a Sphinx client.
+
+    All the requests are looked up at once and the computed results are stored
+    at once.
     """
     # there are requests and to be computed results
     reqs = [req for req in cl._reqs]
-    results = [None] * len(reqs)
-    comp_reqs = []
-    comp_results = []
-
-    # get results from cache
-    for i, req in enumerate(reqs):
-        if req in cache:
-            results[i] = cache.Get(req)
-            results[i]['time'] = 0
-        else:
-            comp_reqs.append(req)
+    keys = _RequestKeys(cl, reqs)
+    results = cache.MGetAged(keys)
+    ages = [age for _, age in results]
+    results = [result for result, _ in results]
+    missing = [i for i, result in enumerate(results) if result is None]
+    cl._reqs = []
 
-    # get results that need to be computed
-    if comp_reqs:
-        cl._reqs = comp_reqs
-        comp_results = SphinxClient.RunQueries(cl)
-    else:
-        cl._reqs = []
+    # keep track of the most used requests to warm up the next generation
+    if getattr(cache, 'track_usage', False):
+        cache.Track(keys, reqs)
 
-    # return None on IO failure
-    if comp_results == None:
-        return None
+    # results from cache
+    for result in results:
+        if result is not None:
+            result['time'] = 0
+
+    # serve the stale results and recompute them in the background
+    soft_expire = getattr(cache, 'soft_expire', 0)
+    stale = [i for i, age in enumerate(ages)
+             if soft_expire and age is not None and age > soft_expire]
+    if stale:
+        for i in stale:
+            cache._ServeStale(ages[i])
+        stale_reqs = dict((cache._MakeKey(keys[i]), reqs[i]) for i in stale)
+        rcl = _RefreshClient(cl)
+
+        def Refresh(comp_keys):
+            rcl._reqs = [stale_reqs[cache._MakeKey(key)] for key in comp_keys]
+            return _RunQueries(rcl)
+        cache.Refresh([keys[i] for i in stale], Refresh)
+
+    # get results that need to be computed and cache them
+    if missing:
+        comp_reqs = dict((cache._MakeKey(keys[i]), reqs[i]) for i in missing)
+
+        def Compute(comp_keys):
+            cl._reqs = [comp_reqs[cache._MakeKey(key)] for key in comp_keys]
+            return _RunQueries(cl)
+        comp_results = _Coalesce(cache, [keys[i] for i in missing], Compute)
+
+        # return None on IO failure
+        if comp_results == None:
+            return None
+        for i, result in zip(missing, comp_results):
+            results[i] = result
+
+    return results
+
+
+class SingleFlight(object):
+    """Coalesces the concurrent computations of the same keys within a process.
+    """
+    def __init__(self):
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def Lead(self, keys):
+        """Returns the keys the caller must compute and a dict of the flights of
+        the keys being computed by other threads.
+        """
+        led, followed = [], {}
+        self._lock.acquire()
+        try:
+            for key in keys:
+                if key in self._flights:
+                    followed[key] = self._flights[key]
+                else:
+                    self._flights[key] = _Flight()
+                    led.append(key)
+        finally:
+            self._lock.release()
+        return led, followed
 
-    # cache computed results and Get results
-    for req, result in zip(comp_reqs, comp_results):
-        if result != None:
-            cache.Set(req, result)
-        results[results.index(None)] = result
+    def Land(self, keys, values):
+        """Hand over the computed values of the keys to the waiting threads.
+        """
+        self._lock.acquire()
+        try:
+            flights = [self._flights.pop(key) for key in keys]
+        finally:
+            self._lock.release()
+        for key, flight in zip(keys, flights):
+            flight.value = values.get(key)
+            flight.event.set()
 
+
+class _Flight(object):
+    def __init__(self):
+        self.value = None
+        self.event = threading.Event()
+
+    def Wait(self, timeout):
+        """Returns a copy of the value computed by the leading thread which is
+        then free to change it, for example when its hits are fetched.
+        """
+        self.event.wait(timeout)
+        return copy.deepcopy(self.value)
+
+
+def _Coalesce(cache, keys, compute):
+    """Used internally to compute and to cache the values of keys missing
+    from the cache.
+
+    The function compute takes a list of keys and returns their values or None
+    on failure. If the cache has single flight enabled, the same key is only
+    computed once by concurrent threads and processes.
+    """
+    flights = getattr(cache, 'flights', None)
+    if not flights:
+        values = compute(keys)
+        if values != None:
+            cache.MSet([(key, value) for key, value in zip(keys, values) if value != None])
+        return values
+
+    mkeys = [cache._MakeKey(key) for key in keys]
+    key_of = dict(zip(mkeys, keys))
+    led, followed = flights.Lead(utils.uniq(mkeys))
+
+    # compute the keys led unless another process is already doing so
+    values, tokens = {}, {}
+    try:
+        for mkey in led:
+            tokens[mkey] = cache.Lock(key_of[mkey])
+        waiting = [mkey for mkey in led if not tokens[mkey]]
+        if waiting:
+            values.update((mkey, value) for mkey, value in
+                zip(waiting, cache.Wait([key_of[mkey] for mkey in waiting], cache.lock_wait))
+                if value != None)
+        if not _ComputeInto(cache, values, [mkey for mkey in led if mkey not in values],
+                            key_of, compute):
+            return None
+    finally:
+        for mkey, token in tokens.items():
+            if token:
+                cache.Unlock(key_of[mkey], token)
+        flights.Land(led, values)
+
+    # wait for the other threads and fall back on computing the keys
+    for mkey, flight in followed.items():
+        value = flight.Wait(cache.lock_wait)
+        if value != None:
+            values[mkey] = value
+    if not _ComputeInto(cache, values, [mkey for mkey in followed if mkey not in values],
+                        key_of, compute):
+        return None
+
+    # a key requested more than once gets a value of its own each time
+    results, seen = [], set()
+    for mkey in mkeys:
+        value = values.get(mkey)
+        if mkey in seen:
+            value = copy.deepcopy(value)
+        seen.add(mkey)
+        results.append(value)
     return results
 
 
+def _ComputeInto(cache, values, mkeys, key_of, compute):
+    """Used internally to compute and cache the values of mkeys into values.
+
+    Returns False on failure of compute.
+    """
+    if not mkeys:
+        return True
+    keys = [key_of[mkey] for mkey in mkeys]
+    computed = compute(keys)
+    if computed == None:
+        return False
+    cache.MSet([(key, value) for key, value in zip(keys, computed) if value != None])
+    values.update(zip(mkeys, computed))
+    return True
+
+
+def IndexGeneration(*paths):
+    """Returns a token which changes whenever one of the indexes is rotated.
+
+    The paths are those of the indexes as declared in the Sphinx config file. The
+    token is made out of the modification times of the index header files. An
+    OSError is raised if one of them cannot be found.
+    """
+    stamps = [repr(os.path.getmtime(path + '.sph')) for path in paths]
+    return hashlib.md5(' '.join(stamps)).hexdigest()[:8]
+
+
+def _RefreshClient(cl):
+    """Used internally to have a client with the settings of cl which can be
+    used by another thread.
+    """
+    if hasattr(cl, 'Clone'):
+        return cl.Clone()
+    rcl = copy.copy(cl)
+    rcl._socket = None
+    return rcl
+
+
+def _RunQueries(cl):
+    """Used internally to run the queries of a client on searchd without caching
+    them.
+    """
+    if hasattr(cl, '_Request'):
+        return cl._Request(SphinxClient.RunQueries)
+    return SphinxClient.RunQueries(cl)
+
+
+def _RequestKeys(cl, reqs):
+    """Used internally to get the cache keys of the requests of a client.
+
+    These are the canonical keys of a fSphinx client if set or the requests.
+    """
+    keys = getattr(cl, '_req_keys', None)
+    if keys is None:
+        return reqs
+    cl._req_keys = []
+    if len(keys) != len(reqs):
+        return reqs
+    return keys
+
+
 def CacheIO(func):
     """Decorator used to memoize the return value of an instance method.
-    The instance is assumed to have a RedisCache.
+    The instance is assumed to have a cache backend.
     """
-    # assumes object has a redis cache
+    # assumes object has a cache backend
     def Wrapper(self, *args, **kwargs):
         key = (func.__name__, args, kwargs)
 
         def Lazy():
             return func(self, *args, **kwargs)
-        if hasattr(self, 'cache') and isinstance(self.cache, RedisCache):
+        if hasattr(self, 'cache') and isinstance(self.cache, CacheBackend):
             return self.cache.GetSet(key, Lazy)
         else:
             return Lazy()
     return Wrapper
+
+
+def _Batches(iterable, size):
+    """Used internally to group the items of any iterable in lists of size items.
+    """
+    iterable = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterable, size))
+        if not batch:
+            break
+        yield batch
+
+
+def _ReadDump(f):
+    """Used internally to read the (key, value, pttl) records of a dump.
+    """
+    while True:
+        header = f.read(16)
+        if not header:
+            break
+        if len(header) < 16:
+            raise IOError('truncated dump file')
+        klen, vlen, pttl = unpack('>IIq', header)
+        k, v = f.read(klen), f.read(vlen)
+        if len(k) < klen or len(v) < vlen:
+            raise IOError('truncated dump file')
+        yield k, v, pttl
+
+
+def _ReadTextDump(f):
+    """Used internally to read the records of the older text dumps.
+
+    The expire of the keys was not dumped so pttl is None.
+    """
+    for l in f:
+        if '@@@@@' not in l:
+            print 'Warning: skipping %s' % l
+            continue
+        k, v = l.rstrip('\n').split('@@@@@', 1)
+        yield k, v, None
@@ -0,0 +1,271 @@
+"""This module builds excerpts and highlights the hits without searchd."""
+
+__all__ = ['ExcerptBuilder', 'LocalExcerpts', 'LocalHighlight']
+
+import re
+from operator import itemgetter
+
+import utils
+from queries import MultiFieldQuery
+
+# the words of a document
+WORD_PATTERN = re.compile('\w+', re.U)
+
+# the words of a query which may end with a wildcard
+QUERY_WORD_PATTERN = re.compile('\w+\*?', re.U)
+
+PHRASE_PATTERN = re.compile('"([^"]*)"', re.U)
+
+# operators of the Sphinx extended syntax which are not searched words
+OPERATORS = set(['maybe', 'sentence', 'paragraph', 'near'])
+
+
+class ExcerptBuilder(object):
+    """Builds excerpts of documents highlighting the terms of a query.
+
+    The options are those of the Sphinx BuildExcerpts function:
+
+    before_match: string to insert before a match (defaults to "<b>").
+    after_match: string to insert after a match (defaults to "</b>").
+    chunk_separator: string to insert between the chunks (defaults to " ... ").
+    limit: maximum size in characters of an excerpt, 0 to highlight the whole
+    document (defaults to 256).
+    around: how many words to keep around each match (defaults to 5).
+
+    # let's build the excerpts of the plot of a movie
+    builder = ExcerptBuilder(limit=128, around=3)
+    builder.Build(plot, builder.Terms('(@plot murder) (@* "secret agent")', 'plot'))
+    """
+    def __init__(self, **opts):
+        self.before_match = opts.get('before_match', '<b>')
+        self.after_match = opts.get('after_match', '</b>')
+        self.chunk_separator = opts.get('chunk_separator', ' ... ')
+        self.limit = opts.get('limit', 256)
+        self.around = opts.get('around', 5)
+
+    @property
+    def opts(self):
+        """The options of this builder as passed to Sphinx BuildExcerpts.
+        """
+        return dict(before_match=self.before_match, after_match=self.after_match,
+                    chunk_separator=self.chunk_separator, limit=self.limit, around=self.around)
+
+    def Terms(self, query, field=None):
+        """Returns the terms of a query searched in the given field.
+
+        Each term is a tuple of the lowercased words of a phrase or of a single
+        word. The negated terms are left out.
+        """
+        if isinstance(query, basestring):
+            query = MultiFieldQuery(query)
+        terms = set()
+        for qt in query:
+            if qt.status == '-':
+                continue
+            if field and qt.sph_field != '*' and field.lower() not in (qt.sph_field, qt.user_field):
+                continue
+            for phrase in PHRASE_PATTERN.findall(qt.term):
+                words = tuple(QUERY_WORD_PATTERN.findall(phrase.lower()))
+                if words:
+                    terms.add(words)
+            for word in PHRASE_PATTERN.sub(' ', qt.term).lower().split():
+                if word[0] in '-!':
+                    continue
+                terms.update((w,) for w in QUERY_WORD_PATTERN.findall(word)
+                             if w not in OPERATORS)
+        return tuple(sorted(terms))
+
+    def Build(self, text, terms):
+        """Returns the excerpt of a text for the terms returned by Terms.
+        """
+        return self._Build(text, terms)[0]
+
+    def _Build(self, text, terms):
+        """Used internally to build an excerpt and count the matches.
+        """
+        text = utils._unicode(text)
+        tokens = [(m.start(), m.end()) for m in WORD_PATTERN.finditer(text)]
+        spans = self._Match(text, tokens, terms)
+        if not self.limit or len(text) <= self.limit or not tokens:
+            return self._Highlight(text, tokens, spans, 0, len(text)), len(spans)
+
+        # windows of words around the matches or the beginning of the text
+        windows = []
+        for start, end in spans:
+            ws, we = max(0, start - self.around), min(len(tokens), end + self.around)
+            if windows and ws <= windows[-1][1]:
+                windows[-1] = (windows[-1][0], max(we, windows[-1][1]))
+            else:
+                windows.append((ws, we))
+        if not windows:
+            windows = [(0, len(tokens))]
+
+        # keep as many windows as fit the limit
+        chunks, kept, size = [], [], 0
+        for ws, we in windows:
+            while we > ws and size + tokens[we - 1][1] - tokens[ws][0] > self.limit:
+                we -= 1
+            if we <= ws:
+                break
+            chunks.append(self._Highlight(text, tokens,
+                [(s, e) for s, e in spans if s >= ws and e <= we], tokens[ws][0], tokens[we - 1][1]))
+            kept.append((ws, we))
+            size += tokens[we - 1][1] - tokens[ws][0] + len(self.chunk_separator)
+        if not chunks:
+            return '', len(spans)
+
+        excerpt = self.chunk_separator.join(chunks)
+        if kept[0][0] > 0:
+            excerpt = self.chunk_separator + excerpt
+        if kept[-1][1] < len(tokens):
+            excerpt += self.chunk_separator
+        return excerpt, len(spans)
+
+    def _Match(self, text, tokens, terms):
+        """Used internally to find the (start, end) words of the terms in a text.
+
+        The longest term is matched first and the matches do not overlap.
+        """
+        exact, prefixes = {}, []
+        for term in terms:
+            if term[0].endswith('*'):
+                prefixes.append(term)
+            else:
+                exact.setdefault(term[0], []).append(term)
+
+        words = [text[start:end].lower() for start, end in tokens]
+        spans, i = [], 0
+        while i < len(words):
+            best = 0
+            for term in exact.get(words[i], []) + prefixes:
+                if len(term) > best and _MatchWords(words, i, term):
+                    best = len(term)
+            if best:
+                spans.append((i, i + best))
+                i += best
+            else:
+                i += 1
+        return spans
+
+    def _Highlight(self, text, tokens, spans, start, end):
+        """Used internally to highlight the spans of text[start:end].
+        """
+        out, pos = [], start
+        for s, e in spans:
+            a, b = tokens[s][0], tokens[e - 1][1]
+            out.extend([text[pos:a], self.before_match, text[a:b], self.after_match])
+            pos = b
+        out.append(text[pos:end])
+        return ''.join(out)
+
+
+def _MatchWords(words, i, term):
+    """Used internally to check whether the term matches the words at i.
+    """
+    if i + len(term) > len(words):
+        return False
+    for word, t in zip(words[i:i + len(term)], term):
+        if t.endswith('*'):
+            if not word.startswith(t[:-1]):
+                return False
+        elif word != t:
+            return False
+    return True
+
+
+class LocalExcerpts(object):
+    """A post processor to build excerpts in process instead of with searchd.
+
+    It takes the same arguments as BuildExcerpts. The terms are those of the
+    query of the client searched in each field. The excerpts may be cached by
+    (document id, field, terms) in any cache backend passed as cache. With
+    fallback=True, the documents in which no term is found, for example because
+    of morphology, are sent to searchd in one BuildExcerpts call.
+
+    # let's build excerpts of the plots and cache them in process
+    LocalExcerpts(cl, 'plot', limit=128, cache=LocalCache(maxbytes=1024 * 1024))
+    """
+    def __init__(self, cl, *on_fields, **opts):
+        self._cl = cl
+        self._on_fields = on_fields
+        self._suffix = opts.pop('suffix', '_excerpts')
+        self._cache = opts.pop('cache', None)
+        self._fallback = opts.pop('fallback', False)
+        self._getter = opts.pop('getter', itemgetter('id'))
+        self._index = opts.pop('index', getattr(cl, 'default_index', '*'))
+        self._builder = ExcerptBuilder(**opts)
+        self._opts_key = tuple(sorted(self._builder.opts.items()))
+
+    def __call__(self, hits):
+        query = self._cl.query
+        terms = dict((f, self._builder.Terms(query, f)) for f in self._on_fields)
+
+        # the fields to build with their cache keys
+        todo = []
+        for match in hits.matches:
+            hit = match['@hit']
+            for f in self._on_fields:
+                if isinstance(hit.get(f), basestring) and terms[f]:
+                    key = ('excerpt', self._getter(match), f, terms[f], self._opts_key)
+                    todo.append((hit, f, key))
+                else:
+                    hit[f + self._suffix] = hit.get(f)
+
+        excerpts = [None] * len(todo)
+        if self._cache:
+            excerpts = self._cache.MGet([key for _, _, key in todo])
+        built, unmatched = [], []
+        for i, (hit, f, key) in enumerate(todo):
+            if excerpts[i] is None:
+                excerpts[i], nb_matches = self._builder._Build(hit[f], terms[f])
+                if not nb_matches and self._fallback:
+                    unmatched.append(i)
+                built.append(i)
+
+        # searchd knows about morphology
+        if unmatched:
+            words = getattr(query, 'sphinx', query)
+            docs = [utils._unicode(todo[i][0][todo[i][1]]) for i in unmatched]
+            results = self._cl.BuildExcerpts(docs, self._index, words, self._builder.opts)
+            for i, excerpt in zip(unmatched, results or []):
+                if excerpt:
+                    excerpts[i] = excerpt
+
+        if self._cache and built:
+            self._cache.MSet([(todo[i][2], excerpts[i]) for i in built])
+        for (hit, f, _), excerpt in zip(todo, excerpts):
+            hit[f + self._suffix] = excerpt or hit[f]
+
+    def Prepare(self, hits):
+        """Used by a Pipeline to build the excerpts row by row, unless they are
+        cached or may fall back on searchd.
+        """
+        if self._cache or self._fallback:
+            return None
+        return _ExcerptRows(self._builder, [(f, self._builder.Terms(self._cl.query, f),
+                            f + self._suffix) for f in self._on_fields])
+
+
+class _ExcerptRows(object):
+    """Used internally to build the excerpts of the fields of a hit.
+    """
+    def __init__(self, builder, fields):
+        self.builder = builder
+        self.fields = fields
+
+    def ProcessRow(self, hit):
+        for f, terms, target in self.fields:
+            value = hit.get(f)
+            if isinstance(value, basestring) and terms:
+                hit[target] = self.builder.Build(value, terms) or value
+            else:
+                hit[target] = value
+
+
+class LocalHighlight(LocalExcerpts):
+    """A post processor to highlight the whole fields in process.
+    """
+    def __init__(self, cl, *on_fields, **opts):
+        opts['suffix'] = opts.get('suffix', '_highlighted')
+        opts['limit'] = opts.get('limit', 0)
+        LocalExcerpts.__init__(self, cl, *on_fields, **opts)
@@ -1,12 +1,15 @@
 """This module adds facet computation to Sphinx."""
 
-__all__ = ['Facet', 'FacetGroup']
+__all__ = ['Facet', 'FacetGroup', 'TermDict']
 
 import sphinxapi
+import threading
+import time
 import weakref
 
 import utils
 from hits import DBFetch
+from hits import Hits
 from hits import DB
 
 try:
@@ -57,13 +60,17 @@ class Facet(object):
     (defaults to "facet_name_terms").
 
     sql_col: name of the column field (defaults to "facet_name").
-    sql_query: the full SQL query which will be called to retrieve the facet terms.
+    sql_query: the full SQL query which will be called to retrieve the facet terms
+    (it must select the id column and the term as sql_col or as its only other
+    column).
 
     attr: name of the corresponding Sphinx attribute (defaults to "facet_name_attr").
     func: grouping function (defaults to sphinxapi.SPH_GROUPBY_ATTR).
     group_sort: group sorting function (defaults to @count).
     sph_field: name of the corresponding Sphinx search field (defaults to "name")
 
+    term_dict: keep the facet terms in memory instead of querying the db (defaults False).
+
     order_by: a lambda function used to order the returned facet values.
     max_num_values: maximum number of facet values (defaults 15).
     cutoff: threshold amount of matches to stop computing (defaults to 0)
@@ -77,11 +84,13 @@ class Facet(object):
         self._sql_table = kwargs.get('sql_table', name + '_terms')
         if self._sql_table:
             sql_query = \
-                'select %s from %s ' % (self._sql_col, self._sql_table) + \
-                'where id in ($id) order by field(id, $id)'
+                'select id, %s from %s ' % (self._sql_col, self._sql_table) + \
+                'where id in ($id)'
         else:
             sql_query = None
         self._sql_query = kwargs.get('sql_query', sql_query)
+        self._custom_sql = 'sql_query' in kwargs
+        self._term_dict = None
 
         # sphinx variables
         self._attr = kwargs.get('attr', self._sql_col + '_attr')
@@ -105,6 +114,8 @@ class Facet(object):
         if cl:
             self._cl = weakref.ref(cl)()
         self._db = kwargs.get('db')
+        if kwargs.get('term_dict'):
+            self.SetTermDict()
 
         self._InitResults()
 
@@ -121,6 +132,21 @@ class Facet(object):
         """
         self._cl = cl
         self._db = db or self._db or cl.db_fetch._db or DB
+        if self._term_dict:
+            self._term_dict.AttachDB(self._db)
+
+    def SetTermDict(self, max_size=0, refresh=0, index_paths=[]):
+        """Resolve the facet terms from memory instead of querying the db.
+
+        By default all the terms of sql_table are loaded once a db is attached.
+        With max_size set, only the max_size most recently used terms are kept
+        and the others are fetched on demand. The terms are reloaded every
+        refresh sec. or whenever one of the indexes in index_paths is rotated.
+        """
+        if not self._sql_table:
+            raise ValueError('a term dictionary requires a sql_table')
+        self._term_dict = TermDict(self._sql_table, self._sql_col, self._db, max_size=max_size,
+                                   refresh=refresh, index_paths=index_paths)
 
     def SetGroupBy(self, attr, func, group_sort='@count desc'):
         """Set grouping attribute, function and grouping sorting clause.
@@ -212,17 +238,29 @@ class Facet(object):
         cl.SetLimits(0, self._max_num_values + more, cutoff=self._cutoff)
         cl.SetSelect(self._set_select)
         cl.SetGroupBy(self._attr, self._func, self._group_sort)
-        cl.AddQuery(getattr(query, 'sphinx', query))
+        # a fSphinx client makes the cache keys out of the query object
+        if getattr(cl, 'canonical_keys', False):
+            cl.AddQuery(query)
+        else:
+            cl.AddQuery(getattr(query, 'sphinx', query))
         LoadSphinxOpts(opts)
 
-    def _SetValues(self, query, sphinx_results, db):
+    def _SetValues(self, query, sphinx_results, db, db_fetch=None):
         """Used internally to set the facet terms and additional values in this facet.
+
+        The terms are fetched by db_fetch if they have already been fetched.
         """
         # reset the facet values and stats
         self.results = utils.storage(time=0, total_found=0, error='', warning='', matches=[])
         
-        # fetch the facet terms from the db
-        db_fetch = DBFetch(db, self._sql_query, getter=lambda x: x['attrs']['@groupby'])
+        # fetch the facet terms from memory or from the db
+        if db_fetch:
+            pass
+        elif self._term_dict:
+            self._term_dict.AttachDB(db)
+            db_fetch = self._term_dict
+        else:
+            db_fetch = DBFetch(db, self._sql_query, getter=lambda x: x['attrs']['@groupby'])
         hits = db_fetch.Fetch(sphinx_results)
         
         # let's get the stats from the results
@@ -232,10 +270,14 @@ class Facet(object):
 
         # finally let's setup the facet values
         for match in hits.matches:
+            # the term may have been removed from the db
+            if '@hit' not in match:
+                continue
             # get all virtual attributes
             value = dict((k, v) for k, v in match['attrs'].items() if k.startswith('@'))
             # get the facet term
-            value['@term'] = match['@hit'][match['@hit'].keys()[-1]]
+            hit = match['@hit']
+            value['@term'] = self._Term(hit)
             # get the value of the grouping func
             value['@groupfunc'] = value.get('@groupfunc', value['@count'])
             # and whether the facet has been selected
@@ -243,6 +285,15 @@ class Facet(object):
             # append each value
             self.results.matches.append(value)
 
+    def _Term(self, hit):
+        """Used internally to get the term of a fetched row. It is the sql_col
+        column or else the first column which is not the id.
+        """
+        if self._sql_col in hit:
+            return hit[self._sql_col]
+        cols = sorted(k for k in hit if k != 'id')
+        return hit[cols and cols[0] or 'id']
+
     def _OrderValues(self):
         """Used internally to order the facet values returned.
         """
@@ -273,7 +324,10 @@ class FacetGroup(object):
     """A FacetGroup is a set of facets which is used for performance and caching.
 
     Only one query to searchd is performed.
-    Caching is performed using a fSphinx client with a RedisCache attached.
+    Caching is performed using a fSphinx client with a cache attached.
+
+    With batch_terms=True, the terms of all the facets are also fetched in one
+    query to the db.
     """
     def __init__(self, *facets, **kwargs):
         # facet variables
@@ -281,6 +335,7 @@ class FacetGroup(object):
         self.time = 0
         self.query = ''
         self.cache = None
+        self.batch_terms = kwargs.get('batch_terms', False)
 
         # sphinx variables
         cl = kwargs.get('cl')
@@ -296,12 +351,24 @@ class FacetGroup(object):
         """
         self._cl = cl
         self._db = db or self._db or cl.db_fetch._db or DB
+        for f in self.facets:
+            if f._term_dict:
+                f._term_dict.AttachDB(self._db)
 
     def AttachCache(self, cache):
-        """Attach a RedisCache to cache the facet computation.
+        """Attach a cache such as a RedisCache or a MMapCache to cache the facet
+        computation.
         """
         self.cache = cache
 
+    def SetBatchTerms(self, batch_terms=True):
+        """Fetch the terms of all the facets in one UNION ALL query to the db.
+
+        Only the facets with the default sql query and without a term dictionary
+        are batched. The other facets fetch their terms as usual.
+        """
+        self.batch_terms = batch_terms
+
     def Compute(self, query, caching=None):
         """Compute all the facet in this gorup for a given query.
 
@@ -351,12 +418,46 @@ class FacetGroup(object):
         """Used internally to set all the facet terms and additional values in the facets
         in this group.
         """
+        fetched = self.batch_terms and self._FetchTerms(results) or {}
         for f in self.facets:
             if f._enable:
-                f._SetValues(query, results.pop(0), self._db)
+                f._SetValues(query, results.pop(0), self._db, fetched.get(f))
                 f._OrderValues()
                 self.time += float(f.results.time)
 
+    def _FetchTerms(self, results):
+        """Used internally to fetch the terms of the batched facets in one query.
+
+        Returns a dict of facet -> fetcher of the terms fetched.
+        """
+        facets = [f for f in self.facets if f._enable]
+        marker = getattr(self._db, 'Marker', None)
+        selects, terms, params = [], {}, []
+        for i, (f, result) in enumerate(zip(facets, results or [])):
+            if not result or f._term_dict or f._custom_sql or not f._sql_table:
+                continue
+            ids = [match['attrs']['@groupby'] for match in result['matches']]
+            if ids:
+                # the ids are passed as parameters if the database supports it
+                if marker:
+                    in_ids = ','.join(marker(len(params) + j) for j in range(len(ids)))
+                    params.extend(ids)
+                else:
+                    in_ids = ','.join(map(str, ids))
+                selects.append('select %s as facet, id, %s as term from %s where id in (%s)' % (
+                    i, f._sql_col, f._sql_table, in_ids))
+                terms[i] = {}
+        if not selects:
+            return {}
+        sql = ' union all '.join(selects)
+        if marker:
+            rows = self._db.query(sql, params)
+        else:
+            rows = self._db.query(sql)
+        for row in rows:
+            terms[int(row.facet)][int(row.id)] = row.term
+        return dict((facets[i], _FetchedTerms(facets[i]._sql_col, t)) for i, t in terms.items())
+
     def __len__(self):
         return len(self.facets)
 
@@ -373,3 +474,153 @@ class FacetGroup(object):
         """
         for f in self.facets:
             yield f
+
+
+class _TermFetcher(object):
+    """Used internally to fetch the facet terms of Sphinx results by id.
+
+    Subclasses must implement Lookup.
+    """
+    def Lookup(self, ids):
+        raise NotImplementedError
+
+    def _FetchInternal(self, hits):
+        ids = [match['attrs']['@groupby'] for match in hits.matches]
+        for match, term in zip(hits.matches, self.Lookup(ids)):
+            if term is not None:
+                match['@hit'] = utils.storage({self._sql_col: term})
+        hits.ids = ids
+
+    def Fetch(self, sphinx_results):
+        """Returns a Hits object with the terms of the given Sphinx results.
+        """
+        return Hits(sphinx_results, self)
+
+
+class _FetchedTerms(_TermFetcher):
+    """Used internally to hand over the terms fetched by a FacetGroup.
+    """
+    def __init__(self, sql_col, terms):
+        self._sql_col = sql_col
+        self._terms = terms
+
+    def Lookup(self, ids):
+        return [self._terms.get(id) for id in ids]
+
+
+class TermDict(_TermFetcher):
+    """An in memory dictionary of the terms of a facet keyed by id.
+
+    By default all the terms of the table are loaded at once. With max_size set,
+    only the max_size most recently used terms are kept and the others are
+    fetched from the db on demand. A term which is not found is also fetched
+    from the db, so new terms are resolved before the dictionary is reloaded.
+
+    The dictionary is shared by the clones of a facet.
+    """
+    def __init__(self, sql_table, sql_col, db=None, max_size=0, refresh=0, index_paths=[]):
+        self._sql_table = sql_table
+        self._sql_col = sql_col
+        self._max_size = max_size
+        self._refresh = refresh
+        self._index_paths = index_paths
+        self._generation = None
+        self._loaded_at = 0
+        self._terms = utils.OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        if db:
+            self.AttachDB(db)
+
+    def AttachDB(self, db):
+        """Attach the db to fetch the terms from and load them if needed.
+        """
+        if db and db is not self._db:
+            self._db = db
+            if not self._max_size and not self._loaded_at:
+                self.Load()
+
+    def Load(self):
+        """Load all the terms of the table.
+        """
+        rows = self._db.query('select id, %s from %s' % (self._sql_col, self._sql_table))
+        terms = utils.OrderedDict((int(row.id), row[self._sql_col]) for row in rows)
+        self._lock.acquire()
+        try:
+            self._terms = terms
+            self._loaded_at = time.time()
+        finally:
+            self._lock.release()
+
+    def Refresh(self):
+        """Reload all the terms or forget them if they are fetched on demand.
+        """
+        if self._max_size:
+            self._lock.acquire()
+            try:
+                self._terms = utils.OrderedDict()
+                self._loaded_at = time.time()
+            finally:
+                self._lock.release()
+        else:
+            self.Load()
+
+    def Lookup(self, ids):
+        """Returns the terms of the ids with None for the ids not found.
+        """
+        self._CheckRefresh()
+        terms = [None] * len(ids)
+        self._lock.acquire()
+        try:
+            for i, id in enumerate(ids):
+                term = self._terms.get(id)
+                if term is not None and self._max_size:
+                    # move the term last as the most recently used
+                    del self._terms[id]
+                    self._terms[id] = term
+                terms[i] = term
+        finally:
+            self._lock.release()
+
+        missing = [id for id, term in zip(ids, terms) if term is None]
+        if missing and self._db:
+            fetched = self._Fetch(missing)
+            self._Store(fetched)
+            terms = [term is None and fetched.get(id) or term for id, term in zip(ids, terms)]
+        return terms
+
+    def _Fetch(self, ids):
+        """Used internally to fetch the terms of the ids from the db.
+        """
+        rows = self._db.query('select id, %s from %s where id in (%s)' % (
+            self._sql_col, self._sql_table, ','.join(map(str, ids))))
+        return dict((int(row.id), row[self._sql_col]) for row in rows)
+
+    def _Store(self, terms):
+        self._lock.acquire()
+        try:
+            self._terms.update(terms)
+            while self._max_size and len(self._terms) > self._max_size:
+                self._terms.popitem(last=False)
+        finally:
+            self._lock.release()
+
+    def _CheckRefresh(self):
+        """Used internally to refresh the terms on schedule or after a reindex.
+        """
+        if self._refresh and time.time() - self._loaded_at > self._refresh:
+            self.Refresh()
+        elif self._index_paths and cache:
+            try:
+                generation = cache.IndexGeneration(*self._index_paths)
+            except OSError, e:
+                # the index files may be missing while they are rotated
+                cache.log.warning('keeping the terms of %s: %s', self._sql_table, e)
+                return
+            if generation != self._generation:
+                if self._generation is not None:
+                    self.Refresh()
+                self._generation = generation
+
+    def __deepcopy__(self, memo):
+        return self
@@ -1,12 +1,21 @@
 """A MySQL read only storage layer for Sphinx to retrieve hits."""
 
-__all__ = ['Hits', 'DBFetch', 'DB', 'SplitOnSep', 'BuildExcerpts', 'Highlight']
+__all__ = ['Hits', 'DBFetch', 'DocStore', 'BuildDocStore', 'DB', 'Pipeline', 'SplitOnSep',
+           'BuildExcerpts', 'Highlight']
 
+import hashlib
+import marshal
+import mmap
+import os
 from operator import itemgetter
+from struct import pack, unpack_from
 import utils
 
 DB = None
 
+# header of the files of a DocStore
+DOCSTORE_MAGIC = 'FSPHINX-DOCS\x01'
+
 
 class DBFetch(object):
     """Creates a DBFetch object to retrieve hits from the database.
@@ -15,6 +24,11 @@ class DBFetch(object):
     will be replaced by the ids that Sphinx returns.
     The db parameter is a handle to your database created with utils.database.
 
+    The rows are put back in the order of Sphinx using their id column given by
+    id_col (defaults to "id"), so the SQL needs no ordering. The matches of the
+    documents missing from the database are removed and their ids are listed
+    in hits.missing.
+
     # let's have a handle to our fsphinx database
     db = utils.database(dbn='mysql', db='fsphinx', user='fsphinx', passwd='fsphinx')
 
@@ -24,36 +38,259 @@ class DBFetch(object):
         imdb_id, filename, title, year, plot,
         (select group_concat(distinct director_name separator '@#@') from directors as d
         where d.imdb_id = t.imdb_id) as directors
-    '''
+        from titles as t
+        where imdb_id in ($id)
+    ''', id_col='imdb_id')
 
     Addtionnally functions to post process the hits could be added.
+
+    The rows may also be kept in a row cache so that the database is only
+    queried for the ids not found in the cache. Any cache backend can be used
+    with a serializer able to handle the column types of the rows:
+
+    # let's keep the rows in process for 60 sec. in front of redis for 1 hour
+    row_cache = LocalCache(RedisCache(db=0, serializer=PickleSerializer()), ttl=60)
+    db_fetch = DBFetch(db, sql, row_cache=row_cache, row_expire=3600)
+
+    The rows of updated documents are removed from the cache with Invalidate.
+
+    With lazy=True, the rows are only fetched and post processed the first time
+    the "@hit" of a match is accessed, and then for all the matches at once.
+    The ids and the stats of the hits are available without any query.
     """
-    def __init__(self, db=DB, sql='', getter=itemgetter('id'), post_processors=[]):
+    def __init__(self, db=DB, sql='', getter=itemgetter('id'), post_processors=[],
+                 row_cache=None, row_expire=0, id_col='id', lazy=False):
         self._db = db
         self._sql = sql
         self._getter = getter
+        self._id_col = id_col
         self._post_processors = post_processors
+        self._row_cache = row_cache
+        self._row_expire = row_expire
+        self._lazy = lazy
+        self._sql_key = hashlib.md5(sql or '').hexdigest()
+        # hit and miss counters of the row cache
+        self.row_hits = 0
+        self.row_misses = 0
 
     def _FetchInternal(self, hits):
-        ids = [self._getter(m) for m in hits.matches]
+        hits.ids = [self._getter(m) for m in hits.matches]
+        hits.missing = []
+        if self._lazy and hits.ids:
+            pending = _PendingFetch(self, hits)
+            hits.matches = [_LazyMatch(m, pending) for m in hits.matches]
+        else:
+            # the matches of the missing documents are removed from this list
+            hits.matches = list(hits.matches)
+            self._Materialize(hits)
+
+    def _Materialize(self, hits):
+        """Used internally to fetch and post process the hits of all the matches.
+        """
+        ids = hits.ids
         if ids:
-            s_ids = ','.join(map(str, ids))
             if not self._sql:
-                values = (utils.storage(id=str(id)) for id in ids)
+                rows = dict((str(id), utils.storage(id=str(id))) for id in ids)
+            elif self._row_cache:
+                rows = self._FetchCached(ids)
             else:
-                values = self._db.query(self._sql.replace('$id', s_ids))
-            for value, match in zip(values, hits.matches):
-                match['@hit'] = value
-            for p in self._post_processors:
-                p(hits)
+                rows = self._RowsById(ids, self._FetchRows(ids))
+            matches = []
+            for id, match in zip(ids, hits.matches):
+                row = rows.get(str(id))
+                if row is None:
+                    hits.missing.append(id)
+                else:
+                    match['@hit'] = row
+                    matches.append(match)
+            if hits.missing:
+                # in place since the matches may be iterated over while fetched
+                hits.matches[:] = matches
+                ids = [self._getter(m) for m in matches]
+            if self._post_processors:
+                Pipeline(*self._post_processors)(hits)
         hits.ids = ids
 
+    def _FetchRows(self, ids):
+        """Used internally to query the database for the rows of the ids.
+
+        The ids are passed as parameters if the database supports it, such as
+        a DBPool.
+        """
+        if not hasattr(self._db, 'Marker'):
+            return self._db.query(self._sql.replace('$id', ','.join(map(str, ids))))
+        # pad the ids to a power of 2 so the driver sees the same statements
+        size = 1
+        while size < len(ids):
+            size *= 2
+        ids = list(ids) + [ids[-1]] * (size - len(ids))
+        parts = self._sql.split('$id')
+        sql = parts[0]
+        for i, part in enumerate(parts[1:]):
+            sql += ','.join(self._db.Marker(i * size + j) for j in range(size)) + part
+        return self._db.query(sql, ids * (len(parts) - 1))
+
+    def _FetchCached(self, ids):
+        """Used internally to look up the rows of all the ids at once in the row
+        cache and to only query the database for the missing ones.
+        """
+        cached = self._row_cache.MGet([self._RowKey(id) for id in ids])
+        rows = dict((str(id), utils.storage(row)) for id, row in zip(ids, cached)
+                    if row is not None)
+        missing = [id for id, row in zip(ids, cached) if row is None]
+        self.row_hits += len(ids) - len(missing)
+        self.row_misses += len(missing)
+        if missing:
+            fetched = self._RowsById(missing, self._FetchRows(missing))
+            self._row_cache.MSet([(self._RowKey(id), dict(fetched[str(id)]))
+                                  for id in missing if str(id) in fetched], self._row_expire)
+            rows.update(fetched)
+        return rows
+
+    def _RowsById(self, ids, rows):
+        """Used internally to key the rows by their id.
+
+        Raises ValueError if the rows have no id column since they cannot be
+        matched to the ids.
+        """
+        rows = list(rows)
+        if rows and self._id_col not in rows[0]:
+            raise ValueError('the rows have no %r column, select it or set id_col' % self._id_col)
+        return dict((str(row[self._id_col]), row) for row in rows)
+
+    def _RowKey(self, id):
+        return ('row', self._sql_key, str(id))
+
+    def Invalidate(self, *ids):
+        """Remove the rows of the given ids from the row cache.
+        """
+        if self._row_cache and ids:
+            self._row_cache.MDelete([self._RowKey(id) for id in ids])
+
     def Fetch(self, sphinx_results):
         """Returns a Hits object for the given Sphinx results.
         """
         return Hits(sphinx_results, self)
 
 
+class DocStore(DBFetch):
+    """Creates a fetcher which reads the hits from a memory mapped document store
+    instead of querying the database.
+
+    The store is a file of records indexed by id which is built offline with
+    BuildDocStore or tools/build_docstore.py. Only the records of the matches
+    are decoded and the multi-valued fields may already be split.
+
+    # let's fetch the hits from the store built from the tutorial SQL
+    db_fetch = DocStore('./data/titles.docs', post_processors=[LocalExcerpts(cl, 'plot')])
+
+    The other options are those of DBFetch. Call Reload once the store is rebuilt.
+    """
+    def __init__(self, path, getter=itemgetter('id'), post_processors=[], **kwargs):
+        # the path also identifies the rows in a row cache
+        DBFetch.__init__(self, None, path, getter, post_processors, **kwargs)
+        self.path = path
+        self._store = None
+        self.Reload()
+
+    def Reload(self):
+        """Map the store again after it has been rebuilt.
+
+        The threads reading the previous store keep it mapped until they are done.
+        """
+        f = open(self.path, 'rb')
+        try:
+            store = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+        if store[:len(DOCSTORE_MAGIC)] != DOCSTORE_MAGIC:
+            raise IOError('%s is not a document store' % self.path)
+        offset = len(DOCSTORE_MAGIC)
+        index, count, length = unpack_from('>QQH', store, offset)
+        id_col = store[offset + 18:offset + 18 + length]
+        # swapped at once and never closed since it may still be read
+        self._store = (store, index, count, id_col)
+
+    def _FetchRows(self, ids):
+        """Used internally to read the records of the ids as (id, row) pairs.
+        """
+        store, index, count, id_col = state = self._store
+        rows = []
+        for id in ids:
+            offset = self._Find(state, int(id))
+            if offset is not None:
+                length = unpack_from('>I', store, offset)[0]
+                row = utils.storage(marshal.loads(store[offset + 4:offset + 4 + length]))
+                rows.append((row[id_col], row))
+        return rows
+
+    def _RowsById(self, ids, rows):
+        return dict((str(id), row) for id, row in rows)
+
+    def _Find(self, state, id):
+        """Used internally to find the offset of the record of an id by binary
+        search in the index of a store.
+        """
+        store, index, count, _ = state
+        lo, hi = 0, count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            mid_id, offset = unpack_from('>QQ', store, index + mid * 16)
+            if mid_id < id:
+                lo = mid + 1
+            elif mid_id > id:
+                hi = mid
+            else:
+                return offset
+        return None
+
+
+def BuildDocStore(path, rows, id_col='id', split=[], sep='@#@'):
+    """Write the rows into a document store read by DocStore.
+
+    The rows are dicts with an integer id in id_col. The fields in split are
+    split on sep. The values which cannot be marshaled are stored as unicode.
+    The store is replaced at once so it can be rebuilt while it is being read.
+    Returns the number of records written.
+    """
+    tmp = path + '.tmp'
+    f = open(tmp, 'wb')
+    try:
+        header = DOCSTORE_MAGIC + pack('>QQH', 0, 0, len(id_col)) + id_col
+        f.write(header)
+        index, offset = [], len(header)
+        for row in rows:
+            record = dict((k, _Marshalable(v)) for k, v in row.items())
+            for k in split:
+                if isinstance(record.get(k), basestring):
+                    record[k] = record[k].split(sep)
+            s = marshal.dumps(record)
+            f.write(pack('>I', len(s)))
+            f.write(s)
+            index.append((int(row[id_col]), offset))
+            offset += 4 + len(s)
+        index.sort()
+        for id, record_offset in index:
+            f.write(pack('>QQ', id, record_offset))
+        f.seek(len(DOCSTORE_MAGIC))
+        f.write(pack('>QQ', offset, len(index)))
+    finally:
+        f.close()
+    os.rename(tmp, path)
+    return len(index)
+
+
+def _Marshalable(value):
+    """Used internally to convert the values such as dates which marshal cannot
+    serialize.
+    """
+    if value is None or isinstance(value, (basestring, bool, int, long, float)):
+        return value
+    if isinstance(value, (list, tuple)):
+        return [_Marshalable(v) for v in value]
+    return utils._unicode(value)
+
+
 class Hits(utils.storage):
     """Returned by DBFetch or create an empty Hits object.
 
@@ -100,6 +337,119 @@ class Hits(utils.storage):
         for match in self.matches:
             yield match
 
+    def Materialize(self):
+        """Fetch the hits of every match now if they are fetched lazily.
+
+        This must be called before serializing lazy hits.
+        """
+        if self.matches and isinstance(self.matches[0], _LazyMatch):
+            self.matches[0]._pending.Run()
+
+
+class _PendingFetch(object):
+    """Used internally to fetch the hits of lazy matches once.
+    """
+    def __init__(self, db_fetch, hits):
+        self.db_fetch = db_fetch
+        self.hits = hits
+        self.done = False
+
+    def Run(self):
+        if not self.done:
+            # the post processors access the hits being fetched
+            self.done = True
+            self.db_fetch._Materialize(self.hits)
+            self.hits = None
+
+
+class _LazyMatch(dict):
+    """Used internally for a match whose "@hit" is fetched on first access.
+    """
+    def __init__(self, match, pending):
+        dict.__init__(self, match)
+        self._pending = pending
+
+    def __getitem__(self, key):
+        if key == '@hit':
+            self._pending.Run()
+        return dict.__getitem__(self, key)
+
+    def get(self, key, default=None):
+        if key == '@hit':
+            self._pending.Run()
+        return dict.get(self, key, default)
+
+    def __contains__(self, key):
+        if key == '@hit':
+            self._pending.Run()
+        return dict.__contains__(self, key)
+
+
+class Pipeline(object):
+    """A post processor which runs post processors with as few passes over the
+    hits as possible.
+
+    The post processors which work row by row are fused so that each hit is
+    processed by all of them at once. A post processor works row by row if its
+    Prepare method returns an object with a ProcessRow(hit) method for the hits.
+    Any other post processor is called with the hits as usual.
+
+    The fused passes over more than min_pool hits may be run by a pool of
+    workers which is any object with a map method, in chunks of chunk_size hits:
+
+    # let's split the fields and build the excerpts of large pages on 4 threads
+    Pipeline(SplitOnSep('director', 'actor'), LocalExcerpts(cl, 'plot'),
+             pool=multiprocessing.pool.ThreadPool(4))
+
+    DBFetch runs its post processors in a pipeline.
+    """
+    def __init__(self, *processors, **opts):
+        self._processors = processors
+        self._pool = opts.get('pool')
+        self._min_pool = opts.get('min_pool', 50)
+        self._chunk_size = opts.get('chunk_size', 25)
+
+    def __call__(self, hits):
+        # consecutive row processors are grouped into a single pass
+        stages = []
+        for p in self._processors:
+            row = hasattr(p, 'Prepare') and p.Prepare(hits) or None
+            if not row:
+                stages.append(p)
+            elif stages and isinstance(stages[-1], _FusedRows):
+                stages[-1].rows.append(row)
+            else:
+                stages.append(_FusedRows([row]))
+
+        for stage in stages:
+            if not isinstance(stage, _FusedRows):
+                stage(hits)
+                continue
+            rows = [match['@hit'] for match in hits.matches]
+            if self._pool and len(rows) > self._min_pool:
+                chunks = [rows[i:i + self._chunk_size]
+                          for i in range(0, len(rows), self._chunk_size)]
+                rows = [row for chunk in self._pool.map(stage, chunks) for row in chunk]
+            else:
+                rows = stage(rows)
+            # the rows may have been processed in another process
+            for match, row in zip(hits.matches, rows):
+                match['@hit'] = row
+
+
+class _FusedRows(object):
+    """Used internally to run row processors on a list of hits in one pass.
+    """
+    def __init__(self, rows):
+        self.rows = rows
+
+    def __call__(self, hits):
+        process = [row.ProcessRow for row in self.rows]
+        for hit in hits:
+            for p in process:
+                p(hit)
+        return hits
+
 
 class SplitOnSep(object):
     """A post processor to split multi value fields which have concatenated using a
@@ -109,13 +459,21 @@ class SplitOnSep(object):
         self._on_fields = on_fields
         self._suffix = opts.get('suffix', '')
         self._sep = opts.get('sep', '@#@')
+        self._targets = [(f, f + self._suffix) for f in on_fields]
 
     def __call__(self, hits):
         for match in hits.matches:
-            hit = match['@hit']
-            for f in self._on_fields:
-                if isinstance(hit[f], basestring):
-                    hit[f + self._suffix] = hit[f].split(self._sep)
+            self.ProcessRow(match['@hit'])
+
+    def Prepare(self, hits):
+        return self
+
+    def ProcessRow(self, hit):
+        sep = self._sep
+        for f, target in self._targets:
+            value = hit[f]
+            if isinstance(value, basestring):
+                hit[target] = value.split(sep)
 
 
 class BuildExcerpts(object):
@@ -137,7 +495,6 @@ class BuildExcerpts(object):
             docs.extend([utils._unicode(match['@hit'][f]) for f in self._on_fields])
 
         all_excerpts = self._cl.BuildExcerpts(docs, self._index, words, self._opts)
-        print all_excerpts
         for match, excerpts in zip(hits.matches, utils.group(all_excerpts, len(self._on_fields))):
             for f, excerpt in zip(self._on_fields, excerpts):
                 match['@hit'][f + self._suffix] = excerpt or match['@hit'][f]
@@ -148,5 +505,5 @@ class Highlight(BuildExcerpts):
     """
     def __init__(self, cl, *on_fields, **opts):
         opts['suffix'] = opts.get('suffix', '_highlighted')
-        opts['limits'] = 2048
+        opts['limit'] = opts.get('limit', 2048)
         BuildExcerpts.__init__(self, cl, *on_fields, **opts)
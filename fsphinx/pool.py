@@ -0,0 +1,287 @@
+"""This module provides pools of persistent connections."""
+
+__all__ = ['ConnectionPool', 'SphinxPool', 'DBPool']
+
+import select
+import sys
+import threading
+import time
+from struct import pack
+
+import sphinxapi
+from sphinxapi import SphinxClient
+
+import utils
+
+
+class ConnectionPool(object):
+    """A thread safe pool of connections which are checked out and returned.
+
+    Subclasses must implement _Connect, _IsAlive and _Close.
+
+    size: maximum number of connections opened at once (defaults to 10).
+    timeout: time in sec. to wait for a connection when all are in use (defaults to 1).
+    max_idle: time in sec. after which an idle connection is closed (defaults to 60).
+    check_idle: time in sec. after which an idle connection is checked before it
+    is reused (defaults to 0, always check).
+    """
+    def __init__(self, size=10, timeout=1.0, max_idle=60, check_idle=0):
+        self.size = size
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.check_idle = check_idle
+        self._idle = []
+        self._used = 0
+        self._cond = threading.Condition(threading.Lock())
+
+    def Get(self, *args):
+        """Check out a connection. The arguments are passed to _Connect.
+
+        Returns None if no connection could be made or if the pool is exhausted
+        for more than timeout seconds.
+        """
+        deadline = time.time() + self.timeout
+        stale = []
+        self._cond.acquire()
+        try:
+            stale = self._Reap()
+            while not self._idle and self._used >= self.size:
+                left = deadline - time.time()
+                if left <= 0:
+                    return None
+                self._cond.wait(left)
+            # take the most recently used connection
+            conn, since = self._idle and self._idle.pop() or (None, None)
+            self._used += 1
+        finally:
+            self._cond.release()
+            # the connections are closed and checked without holding the lock
+            # since it may take a round trip
+            for c in stale:
+                self._Close(c)
+
+        try:
+            if conn and time.time() - since >= self.check_idle and not self._IsAlive(conn):
+                self._Close(conn)
+                conn = None
+            if not conn:
+                conn = self._Connect(*args)
+        finally:
+            if not conn:
+                self._Release()
+        return conn
+
+    def Put(self, conn):
+        """Return a healthy connection to the pool.
+        """
+        self._cond.acquire()
+        try:
+            self._idle.append((conn, time.time()))
+            self._used -= 1
+            self._cond.notify()
+        finally:
+            self._cond.release()
+
+    def Discard(self, conn):
+        """Close a checked out connection which should not be reused.
+        """
+        self._Close(conn)
+        self._Release()
+
+    def Close(self):
+        """Close all the idle connections.
+        """
+        self._cond.acquire()
+        try:
+            for conn, _ in self._idle:
+                self._Close(conn)
+            self._idle = []
+        finally:
+            self._cond.release()
+
+    def _Release(self):
+        self._cond.acquire()
+        try:
+            self._used -= 1
+            self._cond.notify()
+        finally:
+            self._cond.release()
+
+    def _Reap(self):
+        """Used internally to remove the connections idle for too long. Returns
+        them to be closed.
+
+        Must be called with the lock held.
+        """
+        limit = time.time() - self.max_idle
+        stale = []
+        while self._idle and self._idle[0][1] < limit:
+            stale.append(self._idle.pop(0)[0])
+        return stale
+
+    def _Connect(self, *args):
+        raise NotImplementedError
+
+    def _IsAlive(self, conn):
+        raise NotImplementedError
+
+    def _Close(self, conn):
+        raise NotImplementedError
+
+
+class SphinxPool(ConnectionPool):
+    """A pool of persistent connections to searchd which can be attached to a
+    fSphinx client.
+
+    The connections are opened using the settings of the client which checks
+    them out, so a pool should only be shared by clients of the same searchd.
+
+    # let's keep up to 10 connections to searchd
+    cl.AttachConnectionPool(SphinxPool(size=10))
+    """
+    def _Connect(self, cl):
+        sock = SphinxClient._Connect(cl)
+        if sock:
+            # command, command version = 0, body length = 4, body = 1
+            sock.send(pack('>hhII', sphinxapi.SEARCHD_COMMAND_PERSIST, 0, 4, 1))
+        return sock
+
+    def _IsAlive(self, sock):
+        # an alive socket has nothing to read and can be written to
+        try:
+            sr, sw, _ = select.select([sock], [sock], [], 0)
+        except (select.error, ValueError):
+            return False
+        return len(sr) == 0 and len(sw) == 1
+
+    def _Close(self, sock):
+        sock.close()
+
+
+class DBPool(ConnectionPool):
+    """A pool of connections to a database which can be used in place of a
+    utils.database handle by DBFetch and by the facets.
+
+    The connections are opened by calling a DB-API connect function with the
+    given arguments. The ids are then passed to DBFetch queries as parameters.
+
+    # let's keep up to 10 connections to MySQL
+    db = DBPool(MySQLdb.connect, db='fsphinx', user='fsphinx', passwd='fsphinx', size=10)
+
+    # or use a SQLite file instead
+    db = DBPool(sqlite3.connect, 'fsphinx.db')
+
+    A connection is checked out for each query unless the current thread holds
+    one with Acquire. The connections are in autocommit mode so that each query
+    sees the rows committed so far.
+
+    size, timeout and max_idle are those of ConnectionPool. check_idle defaults to
+    1 sec. so that a connection reused right away costs no extra round trip.
+    paramstyle: the paramstyle of the driver (defaults to that of its module).
+    """
+    def __init__(self, connect, *args, **kwargs):
+        ConnectionPool.__init__(self, kwargs.pop('size', 10), kwargs.pop('timeout', 1.0),
+                                kwargs.pop('max_idle', 60), kwargs.pop('check_idle', 1))
+        module = sys.modules.get(connect.__module__.lstrip('_').split('.')[0])
+        self.paramstyle = kwargs.pop('paramstyle', getattr(module, 'paramstyle', 'format'))
+        self._connect = connect
+        self._args = args
+        self._kwargs = kwargs
+        self._local = threading.local()
+
+    def query(self, sql, vars=None):
+        """Run a SQL statement with optional parameters and returns the rows as
+        a list of storage objects.
+
+        With the named paramstyle, a list of parameters is passed by the names
+        given by Marker.
+        """
+        if self.paramstyle == 'named' and isinstance(vars, (list, tuple)):
+            vars = dict(('p%s' % i, v) for i, v in enumerate(vars))
+        conn = getattr(self._local, 'conn', None)
+        if conn:
+            return self._Query(conn, sql, vars)
+        conn = self._Checkout()
+        try:
+            rows = self._Query(conn, sql, vars)
+        except:
+            self.Discard(conn)
+            raise
+        self.Put(conn)
+        return rows
+
+    def Marker(self, i):
+        """Returns the placeholder of the i-th parameter of a statement.
+        """
+        if self.paramstyle == 'qmark':
+            return '?'
+        elif self.paramstyle == 'numeric':
+            return ':%s' % (i + 1)
+        elif self.paramstyle == 'named':
+            return ':p%s' % i
+        return '%s'
+
+    def Acquire(self):
+        """Check out a connection used by all the queries of the current thread
+        until Release is called.
+        """
+        if not getattr(self._local, 'conn', None):
+            self._local.conn = self._Checkout()
+
+    def Release(self):
+        """Return the connection held by the current thread to the pool.
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn:
+            self._local.conn = None
+            self.Put(conn)
+
+    def _Checkout(self):
+        conn = self.Get()
+        if not conn:
+            raise IOError('no connection to the database available')
+        return conn
+
+    def _Query(self, conn, sql, vars):
+        cursor = conn.cursor()
+        try:
+            if vars:
+                cursor.execute(sql, vars)
+            else:
+                cursor.execute(sql)
+            names = [d[0] for d in cursor.description or []]
+            rows = [utils.storage(zip(names, row)) for row in cursor.fetchall()]
+        finally:
+            cursor.close()
+        return rows
+
+    def _Connect(self):
+        conn = self._connect(*self._args, **self._kwargs)
+        # no transaction is left open by the reads, which saves a commit each
+        autocommit = getattr(conn, 'autocommit', None)
+        if callable(autocommit):
+            # MySQLdb and pymysql
+            autocommit(True)
+        elif isinstance(autocommit, bool):
+            # psycopg2
+            conn.autocommit = True
+        elif hasattr(conn, 'isolation_level'):
+            # sqlite3
+            conn.isolation_level = None
+        return conn
+
+    def _IsAlive(self, conn):
+        try:
+            if hasattr(conn, 'ping'):
+                conn.ping()
+            else:
+                conn.cursor().execute('select 1')
+        except Exception:
+            return False
+        return True
+
+    def _Close(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
@@ -1,14 +1,23 @@
 """This module is used to transform a query into a nice url and vice versa."""
 
-__all__ = ['PrettyUrlToQuery', 'QueryToPrettyUrl']
+__all__ = ['PrettyUrlToQuery', 'QueryToPrettyUrl', 'BatchPrettyUrls']
 
 import urlparse
 import urllib
 import re
+import threading
+from bisect import bisect_right
+
 import utils
 
 PATH_PATTERN = re.compile('(\w+)=([^/]+)|([^/]+)')
 
+# number of urls for which PrettyUrlToQuery keeps the query (0 to disable)
+URL_CACHE_SIZE = 1000
+
+_url_queries = utils.OrderedDict()
+_url_lock = threading.Lock()
+
 
 def QueryToPrettyUrl(query, root='', keep_order=True, **kwargs):
     """Takes a query either as a string or a MultiFiedQuery object and returns
@@ -50,12 +59,115 @@ def QueryToPrettyUrl(query, root='', keep_order=True, **kwargs):
     return urlparse.urljoin(root, url)
 
 
+def BatchPrettyUrls(query, terms, root='', keep_order=True, **kwargs):
+    """Returns the pretty urls of the queries made by toggling each of the terms
+    if it is already in the query or by adding it to the query otherwise.
+
+    The urls are those returned by QueryToPrettyUrl, but the url encoded fields
+    of the query are computed once and shared by all the urls.
+
+    # let's get the urls of all the facet values of a page
+    terms = ['@%s %s' % (f.name, value['@term']) for f in fgroup for value in f]
+    urls = BatchPrettyUrls(query, terms, root='/search/')
+    """
+    from queries import MultiFieldQuery, QueryTerm
+    if isinstance(query, basestring):
+        query = MultiFieldQuery(query)
+    qts = list(query)
+
+    # the encoded terms of each field and where each term is
+    items, where = {}, {}
+    for i, qt in enumerate(qts):
+        f = qt.user_field
+        where[qt.key] = (i, f, len(items.setdefault(f, [])))
+        items[f].append(_QuoteTerm(qt.status, qt.term))
+    fields = sorted(items)
+    segments = dict((f, _Segment(f, items[f])) for f in fields)
+
+    # the positions of the terms ordered by field
+    order = sorted(range(len(qts)), key=lambda i: qts[i].user_field)
+    order_fields = [qts[i].user_field for i in order]
+    params = {}
+
+    urls = []
+    for qt in terms:
+        if not isinstance(qt, QueryTerm):
+            qt = QueryTerm.FromString(qt, query.user_sph_map, getattr(query, '_sph_user_map', None))
+        if not qt:
+            path, ot = [segments[f] for f in fields], order
+        elif qt.key in where:
+            # toggle the term
+            i, f, j = where[qt.key]
+            toggled = list(items[f])
+            toggled[j] = _QuoteTerm(qts[i].status != '-' and '-' or '', qts[i].term)
+            path = [g == f and _Segment(f, toggled) or segments[g] for g in fields]
+            ot = order
+        else:
+            # add the term last
+            f = qt.user_field
+            added = items.get(f, []) + [_QuoteTerm(qt.status, qt.term)]
+            path = [segments[g] for g in fields if g != f]
+            path.insert(bisect_right(fields, f) - (f in segments), _Segment(f, added))
+            ot = list(order)
+            ot.insert(bisect_right(order_fields, f), len(qts))
+        url = '%s/' % '/'.join(path)
+
+        ot = keep_order and ''.join(map(str, ot)) or ''
+        if ot not in params:
+            args = dict(kwargs)
+            if len(ot) > 1:
+                args['ot'] = ot
+            params[ot] = args and '?' + urllib.urlencode(args, doseq=True) or ''
+        urls.append(urlparse.urljoin(root, url + params[ot]))
+    return urls
+
+
+def _QuoteTerm(status, term):
+    """Used internally to url encode a term of a pretty url.
+    """
+    return utils.urlquote_plus('%s%s' % (status == '-' and '*' or '', term), safe='/|*=')
+
+
+def _Segment(field, items):
+    """Used internally to make the path segment of the encoded terms of a field.
+    """
+    if field == '*':
+        return '|'.join(items)
+    return '%s=%s' % (utils.urlquote_plus(field, safe='/|*='), '|'.join(items))
+
+
 def PrettyUrlToQuery(url, root='', order=''):
     """Transforms a pretty url into a query.
 
     The order of the query terms is given using a url query parameter of name "ot"
     or by explicitely using the order variable.
+
+    The queries of the URL_CACHE_SIZE most recent urls are kept in memory.
     """
+    if not URL_CACHE_SIZE:
+        return _PrettyUrlToQuery(url, root, order)
+    key = (url, root, order)
+    _url_lock.acquire()
+    try:
+        query = _url_queries.pop(key, None)
+        if query is not None:
+            _url_queries[key] = query
+            return query
+    finally:
+        _url_lock.release()
+
+    query = _PrettyUrlToQuery(url, root, order)
+    _url_lock.acquire()
+    try:
+        _url_queries[key] = query
+        while len(_url_queries) > URL_CACHE_SIZE:
+            _url_queries.popitem(last=False)
+    finally:
+        _url_lock.release()
+    return query
+
+
+def _PrettyUrlToQuery(url, root='', order=''):
     root = root.split('/')
     url = urlparse.urlparse(url)
     path = utils.unquote_plus(url.path)
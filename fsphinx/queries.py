@@ -3,7 +3,11 @@
 __all__ = ['MultiFieldQuery', 'QueryTerm', 'QueryParser']
 
 import copy
+import itertools
 import re
+import threading
+from operator import attrgetter
+
 import utils
 
 QUERY_PATTERN = re.compile('''
@@ -12,13 +16,20 @@ QUERY_PATTERN = re.compile('''
     (?P<all>[^@()]+)''',
     re.I | re.U | re.X)
 
+# bug in sphinx: make science-fiction -> science fiction
+HYPHEN_PATTERN = re.compile('(\w)(-)(\w)', re.U)
+
+# changes whenever the key of a term which may be indexed by a query is changed
+_key_changes = itertools.count(1)
+_key_version = 0
+
 
 def ChangeQuery(func):
     def Wrapper(self, query):
         if isinstance(query, basestring):
             query = MultiFieldQuery(query, user_sph_map=self.user_sph_map)
         elif isinstance(query, QueryTerm):
-            query_term = copy.deepcopy(query)
+            query_term = copy.copy(query)
             query = MultiFieldQuery(user_sph_map=self.user_sph_map)
             query.AddQueryTerm(query_term)
         return func(self, query)
@@ -28,20 +39,82 @@ def ChangeQuery(func):
 def ChangeQueryTerm(func):
     def Wrapper(self, query_term):
         if isinstance(query_term, basestring):
-            query_term = QueryTerm.FromString(query_term, user_sph_map=self.user_sph_map)
+            query_term = QueryTerm.FromString(query_term, self.user_sph_map, self._sph_user_map)
         return func(self, query_term)
     return Wrapper
 
 
 class QueryParser(object):
     """Creates a query parser of the given type. Returns a ParsedQuery.
+
+    The cache_size most recently parsed queries are kept (defaults to 1000, 0 to
+    disable the cache). A query found in the cache is returned as a derived query
+    made of copies of its terms, so the cached query is never changed.
+
+    The rewriters are applied in turn to the terms of the parsed queries before
+    they are sent to Sphinx or used as cache keys, so that the variants of a
+    query are searched and cached once. The terms seen by the user are left as
+    they were entered.
+
+    # let's normalize the queries before searching them
+    QueryParser(MultiFieldQuery, rewriters=[DropNoopNegations(), CaseFold(), Dedupe(),
+                                            SortTerms(), MergeFields()])
     """
     def __init__(self, type, **kwargs):
         self.type = type
+        self.cache_size = kwargs.pop('cache_size', 1000)
+        self.rewriters = kwargs.pop('rewriters', [])
         self.kwargs = kwargs
+        # hit and miss counters of the parse cache
+        self.hits = 0
+        self.misses = 0
+        self._parsed = utils.OrderedDict()
+        self._lock = threading.Lock()
+        self._kwargs_key = repr(sorted((k, sorted(v.items()) if isinstance(v, dict) else v)
+                                       for k, v in kwargs.items()))
 
     def Parse(self, query):
+        if not self.cache_size:
+            return self._Parse(query)
+        key = (query, self._kwargs_key)
+        self._lock.acquire()
+        try:
+            q = self._parsed.pop(key, None)
+            if q is not None:
+                self._parsed[key] = q
+                self.hits += 1
+            else:
+                self.misses += 1
+        finally:
+            self._lock.release()
+
+        if q is None:
+            q = self._Parse(query)
+            self._lock.acquire()
+            try:
+                self._parsed[key] = q
+                while len(self._parsed) > self.cache_size:
+                    self._parsed.popitem(last=False)
+            finally:
+                self._lock.release()
+        q = q._Derive(q._qts)
+        q.user_sph_map, q._sph_user_map = dict(q.user_sph_map), dict(q._sph_user_map)
+        return q
+
+    @property
+    def hit_rate(self):
+        """The proportion of the queries found in the parse cache.
+        """
+        return float(self.hits) / max(1, self.hits + self.misses)
+
+    def __deepcopy__(self, memo):
+        # the parse cache is shared by the clones of a client
+        return self
+
+    def _Parse(self, query):
         q = self.type(**self.kwargs)
+        if self.rewriters:
+            q.rewriters = self.rewriters
         q.Parse(query)
         return q
         
@@ -60,13 +133,27 @@ class MultiFieldQuery(object):
 
     The class variable ALLOW_EMPTY controls whether to interpret an empty query
     as '' leading Sphinx to full scan mode.
+
+    The queries derived by the query algebra get shallow copies of the terms,
+    so a term may be toggled in a query without changing the others.
     """
 
     ALLOW_EMPTY = False
 
+    # the terms for which _index holds the positions by key
+    _indexed = None
+    _index_version = None
+
+    # the rewriters of the terms sent to sphinx (see QueryParser)
+    rewriters = ()
+
+    # the rewritten terms along with the terms they were rewritten from
+    _rewritten = None
+
     def __init__(self, query='', user_sph_map={}):
         self.user_sph_map = dict((k.lower(), v.lower()) for k, v in user_sph_map.items())
-        self._qts = []
+        self._sph_user_map = utils.dictreverse(self.user_sph_map)
+        self._qts = ()
         if query:
             self.Parse(query)
 
@@ -76,9 +163,9 @@ class MultiFieldQuery(object):
         Every query passed to a facet or to a sphinx client must have been parsed
         beforehand.
         """
-        self._qts = []
+        self._qts = ()
         for m in QUERY_PATTERN.finditer(query):
-            query_term = QueryTerm.FromMatchObject(m, self.user_sph_map)
+            query_term = QueryTerm.FromMatchObject(m, self.user_sph_map, self._sph_user_map)
             if query_term:
                 self.AddQueryTerm(query_term)
 
@@ -86,29 +173,46 @@ class MultiFieldQuery(object):
     def AddQueryTerm(self, query_term):
         """Used internally to add a query term as a QueryTerm object.
         """
-        if query_term in self:
-            self._qts.remove(query_term)
-        if query_term:
-            self._qts.append(query_term)
+        if not query_term:
+            return
+        self.RemoveQueryTerm(query_term)
+        index = self._Index()
+        index[query_term.key] = len(self._qts)
+        self._qts += (query_term,)
+        self._indexed = self._qts
 
     @ChangeQueryTerm
     def RemoveQueryTerm(self, query_term):
         """Used internally to remove a query term as a QueryTerm object.
         """
-        if query_term in self:
-            self._qts.remove(query_term)
+        index = self._Index()
+        i = index.pop(getattr(query_term, 'key', None), None)
+        if i is not None:
+            self._qts = self._qts[:i] + self._qts[i + 1:]
+            for qt in self._qts[i:]:
+                index[qt.key] -= 1
+            self._indexed = self._qts
+
+    def _Index(self):
+        """Used internally to get the positions of the terms by key.
+        """
+        if self._indexed is not self._qts or self._index_version != _key_version:
+            self._index_version = _key_version
+            self._index = dict((qt.key, i) for i, qt in enumerate(self._qts))
+            self._indexed = self._qts
+        return self._index
 
     @property
     def user(self):
         """A representation of this query as manipulated by the user.
         """
-        return ' '.join(qt.user for qt in self)
+        return ' '.join(qt.user for qt in self._qts)
 
     @property
     def sphinx(self):
         """The string representation of this query which should be sent to sphinx.
         """
-        s = utils.strips(' '.join(qt.sphinx for qt in self))
+        s = utils.strips(' '.join(qt.sphinx for qt in self.Rewrite()))
         if s == '(@* "")':
             s = ''
         if not s and not self.ALLOW_EMPTY:
@@ -119,41 +223,89 @@ class MultiFieldQuery(object):
     def uniq(self):
         """A canonical / unique string representation of this query.
         """
-        return utils.strips(' '.join(qt.uniq for qt in sorted(self)))
+        return utils.strips(' '.join(qt.uniq for qt in sorted(self.Rewrite())))
+
+    def Rewrite(self):
+        """Returns the terms of this query as they are sent to sphinx once
+        rewritten by each of the rewriters.
+
+        The rewritten terms are kept until the query or one of its terms changes.
+        """
+        if not self.rewriters:
+            return list(self._qts)
+        state = (tuple(self.rewriters), map(_TermState, self._qts))
+        if self._rewritten is None or self._rewritten[0] != state:
+            qts = list(self._qts)
+            for rewriter in self.rewriters:
+                qts = rewriter(qts)
+            self._rewritten = (state, tuple(qts))
+        return list(self._rewritten[1])
 
     def count(self, field):
         """Returns a count of how many times this field appears is in the query.
         """
-        return sum(1 for qt in self if (field.lower() in (qt.user_field, qt.sph_field) and qt.status != '-'))
+        return sum(1 for qt in self._qts if (field.lower() in (qt.user_field, qt.sph_field) and qt.status != '-'))
+
+    def _Derive(self, qts):
+        """Used internally to get a query of the same type as this one made of
+        copies of the terms qts.
+        """
+        q = copy.copy(self)
+        q._qts = tuple(copy.copy(qt) for qt in qts)
+        if qts is self._qts:
+            # the copies have the same keys at the same positions
+            q._index = dict(self._Index())
+            q._indexed, q._index_version = q._qts, self._index_version
+        else:
+            q._indexed = None
+        q._rewritten = None
+        return q
 
     @ChangeQueryTerm
     def __getitem__(self, query_term):
         if isinstance(query_term, int):
-            return self._qts[query_term]
-        return self._qts[self._qts.index(query_term)]
+            i = range(len(self._qts))[query_term]
+        else:
+            i = self._Index().get(getattr(query_term, 'key', None))
+            if i is None:
+                raise ValueError('%r is not in the query' % query_term)
+        return self._qts[i]
 
     @ChangeQueryTerm
     def __contains__(self, query_term):
-        return query_term in self._qts
+        return getattr(query_term, 'key', None) in self._Index()
 
     def __iter__(self):
         """Iterates over query terms in order.
         """
-        for qt in self._qts:
-            yield qt
+        return iter(self._qts)
 
     def __str__(self):
         return self.user
 
     def __repr__(self):
-        return repr(self._qts)
+        return repr(list(self._qts))
+
+    def __getstate__(self):
+        # the index is by identity so it is not kept
+        state = self.__dict__.copy()
+        for name in ('_index', '_indexed', '_index_version', '_rewritten'):
+            state.pop(name, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        # the queries pickled by older versions keep their terms in a list
+        self._qts = tuple(self._qts)
+        if '_sph_user_map' not in state:
+            self._sph_user_map = utils.dictreverse(self.user_sph_map)
 
     @ChangeQuery
     def __and__(self, query):
-        q = self - self  # hack to permit subclassing
-        for query_term in query:
-            if query_term in self and query_term in query:
-                q.AddQueryTerm(query_term)
+        q = self._Derive(())
+        for query_term in query._qts:
+            if query_term in self:
+                q.AddQueryTerm(copy.copy(query_term))
         return q
 
     @ChangeQuery
@@ -162,16 +314,13 @@ class MultiFieldQuery(object):
 
     @ChangeQuery
     def __sub__(self, query):
-        q = copy.deepcopy(self)
-        for query_term in query:
-            q.RemoveQueryTerm(query_term)
-        return q
+        return self._Derive(qt for qt in self._qts if qt not in query)
 
     @ChangeQuery
     def __add__(self, query):
-        q = copy.deepcopy(self)
-        for query_term in query:
-            q.AddQueryTerm(query_term)
+        q = self._Derive(self._qts)
+        for query_term in query._qts:
+            q.AddQueryTerm(copy.copy(query_term))
         return q
 
     def __len__(self):
@@ -179,37 +328,67 @@ class MultiFieldQuery(object):
 
     @ChangeQueryTerm
     def GetQueryToggle(self, query_term):
-        query = copy.deepcopy(self)
+        query = self._Derive(self._qts)
         query[query_term].Toggle()
         return query
 
     def GetQueryFilter(self, ffilter):
-        query = self - self  # permit subclassing
-        for qt in self:
-            if ffilter(qt):
-                query.AddQueryTerm(qt)
-        return query
+        return self._Derive(qt for qt in self._qts if ffilter(qt))
 
     def ToPrettyUrl(self, **kwargs):
         from pretty_url import QueryToPrettyUrl
         return QueryToPrettyUrl(self, **kwargs)
 
 
+def _Invalidating(name, *cached):
+    """Used internally to make a property which resets the cached values derived
+    from the attribute name when it is set.
+    """
+    def fset(self, value):
+        global _key_version
+        if '_key' in cached and getattr(self, '_key', None) is not None:
+            # the queries holding this term must index it again
+            _key_version = next(_key_changes)
+        setattr(self, name, value)
+        for c in cached:
+            setattr(self, c, None)
+    return property(attrgetter(name), fset)
+
+
 class QueryTerm(object):
     """Used internally by a multi-field query.
 
     Query terms may be created from a match object or its string representation.
+
+    The sphinx and uniq strings, the key and the hash of a term are computed once
+    and reset when its status, term or fields are changed.
     """
-    def __init__(self, status, field, term, user_sph_map={}):
+    __slots__ = ('_status', '_term', '_user_field', '_sph_field', '_sphinx', '_uniq',
+                 '_key', '_hash')
+
+    # the slots which are kept when a term is pickled
+    _STATE = ('_status', '_term', '_user_field', '_sph_field')
+
+    status = _Invalidating('_status', '_sphinx', '_uniq')
+    term = _Invalidating('_term', '_sphinx', '_uniq', '_key', '_hash')
+    user_field = _Invalidating('_user_field', '_key', '_hash')
+    sph_field = _Invalidating('_sph_field', '_sphinx', '_uniq')
+
+    def __init__(self, status, field, term, user_sph_map={}, sph_user_map=None):
         self.status = status
         self.term = utils.strips(term)
         field = field.strip().lower()
-        self.user_field = utils.dictreverse(user_sph_map).get(field, field).lower()
+        if sph_user_map is None:
+            sph_user_map = utils.dictreverse(user_sph_map)
+        self.user_field = sph_user_map.get(field, field).lower()
         self.sph_field = user_sph_map.get(field, field).lower()
 
     @classmethod
-    def FromMatchObject(cls, m, user_sph_map={}):
+    def FromMatchObject(cls, m, user_sph_map={}, sph_user_map=None):
         """Create a QueryTerm from a match object.
+
+        The reverse of user_sph_map may be passed as sph_user_map so that it is
+        not computed for each term.
         """
         if not m:
             return None
@@ -221,14 +400,14 @@ class QueryTerm(object):
         if status != '-':
             status = ''
         if field.strip():
-            return cls(status, field, term, user_sph_map)
+            return cls(status, field, term, user_sph_map, sph_user_map)
 
     @classmethod
-    def FromString(cls, s, user_sph_map={}):
+    def FromString(cls, s, user_sph_map={}, sph_user_map=None):
         """Create a QueryTerm from a string.
         """
         m = QUERY_PATTERN.search(s)
-        return cls.FromMatchObject(m, user_sph_map)
+        return cls.FromMatchObject(m, user_sph_map, sph_user_map)
 
     @property
     def user(self):
@@ -241,35 +420,69 @@ class QueryTerm(object):
         """The string representation of this query term which should be sent to
         sphinx.
         """
-        # bug in sphinx: make science-fiction -> science fiction
-        term = re.sub('(\w)(-)(\w)', '\\1 \\3', self.term, re.U)
-        if self.status in ('', '+'):
-            return '(@%s %s)' % (self.sph_field, term)
-        else:
-            return ''
+        if self._sphinx is None:
+            if self._status in ('', '+'):
+                self._sphinx = '(@%s %s)' % (self._sph_field,
+                                             HYPHEN_PATTERN.sub('\\1 \\3', self._term))
+            else:
+                self._sphinx = ''
+        return self._sphinx
 
     @property
     def uniq(self):
         """A canonical / unique string representation of this query term.
         """
-        return self.sphinx.strip().lower()
+        if self._uniq is None:
+            self._uniq = self.sphinx.strip().lower()
+        return self._uniq
+
+    @property
+    def key(self):
+        """The key by which query terms are compared, hashed and indexed.
+        """
+        if self._key is None:
+            self._key = (self._user_field, self._term.lower())
+        return self._key
 
     def __str__(self):
         return self.user
 
     def __repr__(self):
-        return '<%s>' % vars(self)
+        return '<%s>' % dict(status=self.status, term=self.term, user_field=self.user_field,
+                             sph_field=self.sph_field)
+
+    def __copy__(self):
+        qt = object.__new__(self.__class__)
+        for name in QueryTerm.__slots__:
+            setattr(qt, name, getattr(self, name))
+        if hasattr(self, '__dict__'):
+            qt.__dict__.update(self.__dict__)
+        return qt
+
+    def __getstate__(self):
+        # the hash of a string may differ from one process to another
+        state = dict((name, getattr(self, name)) for name in QueryTerm._STATE)
+        state.update(getattr(self, '__dict__', {}))
+        return state
+
+    def __setstate__(self, state):
+        for name in QueryTerm.__slots__:
+            setattr(self, name, None)
+        for name, value in state.items():
+            setattr(self, name, value)
 
     def __cmp__(self, qt):
         """Two query terms are considered equal case insensitively of their term
         value.
         """
-        return cmp((self.user_field, self.term.lower()), (qt.user_field, qt.term.lower()))
+        return cmp(self.key, qt.key)
 
     def __hash__(self):
         """Used by MultiFieldQuery.__contains__.
         """
-        return hash((self.user_field, self.term.lower()))
+        if self._hash is None:
+            self._hash = hash(self.key)
+        return self._hash
 
     def Toggle(self):
         self.status = self.status != '-' and '-' or ''
@@ -279,3 +492,7 @@ class QueryTerm(object):
 
     def ToggleOff(self):
         self.status = '-'
+
+
+# the attributes of a term from which the rewritten terms are made
+_TermState = attrgetter(*QueryTerm._STATE)
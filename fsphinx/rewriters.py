@@ -0,0 +1,116 @@
+"""This module rewrites the queries sent to Sphinx into a normal form."""
+
+__all__ = ['CaseFold', 'Dedupe', 'DropNoopNegations', 'MergeFields', 'SortTerms']
+
+import copy
+import re
+
+from excerpts import OPERATORS
+
+# a term made only of words, which Sphinx matches as all of its words
+SIMPLE_TERM_PATTERN = re.compile('^\w+(?:(?:\s+|-)\w+)*$', re.U)
+
+# the operators of the extended syntax, such as MAYBE or NEAR/3, which are case sensitive
+OPERATOR_PATTERN = re.compile('(\\b(?:%s)(?:/\\d+)?\\b)' % '|'.join(sorted(OPERATORS)).upper(), re.U)
+
+
+class CaseFold(object):
+    """A query rewriter to lowercase the terms.
+
+    Sphinx matches the words case insensitively as long as the charset_table of
+    the index folds case, which is the default. The operators are left as they
+    are since Sphinx only knows them in uppercase.
+    """
+    def __call__(self, qts):
+        return [_Change(qt, term=_Lower(qt.term)) for qt in qts]
+
+
+class Dedupe(object):
+    """A query rewriter to remove the terms searched more than once in the same
+    Sphinx field.
+
+    A simple term searched in all fields (@*) is also removed when it is searched
+    in a given field.
+    """
+    def __call__(self, qts):
+        in_fields = set(_Lower(qt.term) for qt in qts if qt.status != '-' and qt.sph_field != '*')
+        seen, kept = set(), []
+        for qt in qts:
+            if qt.status != '-':
+                key = (qt.sph_field, _Lower(qt.term))
+                if key in seen:
+                    continue
+                if qt.sph_field == '*' and key[1] in in_fields and _IsSimple(qt.term):
+                    continue
+                seen.add(key)
+            kept.append(qt)
+        return kept
+
+
+class DropNoopNegations(object):
+    """A query rewriter to remove the terms which are toggled off or empty since
+    they are not searched.
+    """
+    def __call__(self, qts):
+        return [qt for qt in qts if qt.status != '-' and qt.term.strip('" ')]
+
+
+class MergeFields(object):
+    """A query rewriter to merge the simple terms of the same Sphinx field into a
+    single term which matches the same documents.
+
+    # the terms are all searched so (@genre drama) (@genre comedy) becomes
+    (@genre drama comedy)
+    """
+    def __call__(self, qts):
+        first, merged = {}, []
+        for qt in qts:
+            if qt.status == '-' or not _IsSimple(qt.term):
+                merged.append(qt)
+            elif qt.sph_field in first:
+                i = first[qt.sph_field]
+                words = merged[i].term.split()
+                words.extend(w for w in qt.term.split() if w not in words)
+                merged[i] = _Change(merged[i], term=' '.join(words))
+            else:
+                first[qt.sph_field] = len(merged)
+                merged.append(qt)
+        return merged
+
+
+class SortTerms(object):
+    """A query rewriter to order the terms by field and term so that the same
+    terms entered in any order make the same query.
+    """
+    def __call__(self, qts):
+        return sorted(qts, key=lambda qt: (qt.sph_field, qt.term.lower()))
+
+
+def _IsSimple(term):
+    """Used internally to check whether a term is only made of words which are
+    all searched. A term with operators such as a MAYBE b is not.
+    """
+    return bool(SIMPLE_TERM_PATTERN.match(term)) and not OPERATOR_PATTERN.search(term)
+
+
+def _Lower(term):
+    """Used internally to lowercase a term except for its operators.
+    """
+    parts = OPERATOR_PATTERN.split(term)
+    parts[::2] = [part.lower() for part in parts[::2]]
+    return ''.join(parts)
+
+
+def _Change(qt, **attrs):
+    """Used internally to get a query term with the given attributes changed
+    without modifying the term itself.
+    """
+    if all(getattr(qt, k) == v for k, v in attrs.items()):
+        return qt
+    qt = copy.copy(qt)
+    # the copy is not indexed by any query so changing its key must not make
+    # the queries index their terms again
+    qt._key = qt._hash = None
+    for k, v in attrs.items():
+        setattr(qt, k, v)
+    return qt
@@ -7,14 +7,21 @@ import sys
 import weakref
 
 import utils
+import sphinxapi
 from sphinxapi import SphinxClient
 from facets import FacetGroup
 from facets import Facet
 from hits import Hits
 import cache
 
+# settings of a client which change the results of a query
+REQUEST_SETTINGS = [
+    '_offset', '_limit', '_mode', '_weights', '_sort', '_sortby', '_min_id', '_max_id',
+    '_filters', '_groupby', '_groupfunc', '_groupsort', '_groupdistinct', '_maxmatches',
+    '_cutoff', '_retrycount', '_retrydelay', '_anchor', '_indexweights', '_ranker',
+    '_rankexpr', '_maxquerytime', '_fieldweights', '_overrides', '_select', '_query_flags',
+    '_predictedtime', '_outerorderby', '_outeroffset', '_outerlimit', '_hasouter']
 
-# NOTE: batch queries with AddQuery and RunQueries are not implemented.
 
 class FSphinxClient(SphinxClient):
     def __init__(self):
@@ -25,7 +32,10 @@ class FSphinxClient(SphinxClient):
         self.default_index = '*'
         self.db_fetch = None
         self.cache = None
+        self.pool = None
         self.sort_mode_options = []
+        self.batch_facets = False
+        self.canonical_keys = False
 
         # the returned results
         self.query = ''
@@ -33,6 +43,8 @@ class FSphinxClient(SphinxClient):
         self.facets = FacetGroup()
 
         SphinxClient.__init__(self)
+        self._pooled = None
+        self._req_keys = []
 
     def AttachQueryParser(self, query_parser):
         """Attach a query parser so every query will be parsed using it.
@@ -47,7 +59,8 @@ class FSphinxClient(SphinxClient):
     def AttachFacets(self, *facets, **kwargs):
         """Attach a list of facet which will be computed.
 
-        The facets are put into a FacetGroup for performance.
+        The facets are put into a FacetGroup for performance. With batch_terms=True
+        the terms of all the facets are fetched in one query to the db.
         """
         # if not found get db from db_fetch
         db = kwargs.get('db')
@@ -60,16 +73,39 @@ class FSphinxClient(SphinxClient):
             cl = weakref.proxy(self)
 
         # set the facets and the Sphinx client
-        self.facets = FacetGroup(*facets)
+        self.facets = FacetGroup(*facets, batch_terms=kwargs.get('batch_terms', False))
         self.facets.AttachSphinxClient(cl, db)
 
     def AttachCache(self, cache):
-        """Attach a RedisCache to cache the results.
+        """Attach a cache such as a RedisCache or a MMapCache to cache the results.
 
         If facets are attached, this will also cache the facets.
         """
         self.cache = cache
 
+    def AttachConnectionPool(self, pool):
+        """Attach a SphinxPool to reuse persistent connections to searchd.
+
+        The pool is shared by the clones of this client and by the facets.
+        """
+        self.pool = pool
+
+    def SetBatchFacets(self, batch=True):
+        """Compute the facets in the same batch of queries as the main query.
+
+        Only one round trip to searchd is then performed for each call to Query.
+        """
+        self.batch_facets = batch
+
+    def SetCanonicalKeys(self, canonical=True):
+        """Cache the results using the canonical form of the queries.
+
+        The cache keys are then made of MultiFieldQuery.uniq and of the client
+        settings instead of the raw Sphinx requests, so that equivalent queries
+        share the same cache entries.
+        """
+        self.canonical_keys = canonical
+
     def SetDefaultIndex(self, index):
         """Sets a default index so we don't have to pass it to Query each time.
 
@@ -90,11 +126,22 @@ class FSphinxClient(SphinxClient):
             sort_mode = (mode, clause)
         SphinxClient.SetSortMode(self, *sort_mode)
 
+    def AddQuery(self, query, index='*', comment=''):
+        """Adds a query to the batch. The query could be a string or a
+        MultiFieldQuery object.
+        """
+        if self.canonical_keys:
+            self._req_keys.append(self._MakeRequestKey(query, index, comment))
+        return SphinxClient.AddQuery(self, getattr(query, 'sphinx', query), index, comment)
+
     def RunQueries(self, caching=None):
-        if not self.cache or caching is False:
-            return SphinxClient.RunQueries(self)
-        else:
-            return cache.CacheSphinx(self.cache, self)
+        try:
+            if not self.cache or caching is False:
+                return self._Request(SphinxClient.RunQueries)
+            else:
+                return cache.CacheSphinx(self.cache, self)
+        finally:
+            self._req_keys = []
 
     def Query(self, query, index='', comment=''):
         """Processes the query as Sphinx normally would.
@@ -109,9 +156,12 @@ class FSphinxClient(SphinxClient):
         # check the default index
         index = index or self.default_index
 
-        # let's perform a normal query
-        results = SphinxClient.Query(self, getattr(query, 'sphinx', query), index, comment)
-     
+        # let's perform a normal query or batch it with the facets
+        if self.batch_facets and self.facets:
+            results, facet_results = self._QueryWithFacets(query, index, comment)
+        else:
+            results = SphinxClient.Query(self, query, index, comment)
+
         # let's fetch the hits from the DB if possible
         if self.db_fetch and results and results['total_found']:
             self.hits = self.db_fetch.Fetch(results)
@@ -119,12 +169,102 @@ class FSphinxClient(SphinxClient):
             self.hits = Hits(results)
 
         # let's compute the facets if possible
-        if self.facets and results and results['total_found']:
+        if self.batch_facets and self.facets:
+            if results:
+                self.facets._SetValues(query, facet_results)
+        elif self.facets and results and results['total_found']:
             self.facets.Compute(query)
 
         # keep expected return of SphinxClient
         return self.hits
 
+    def _MakeRequestKey(self, query, index, comment):
+        """Used internally to make a cache key out of the canonical form of the
+        query and of the settings of this client.
+        """
+        query = getattr(query, 'uniq', '') or getattr(query, 'sphinx', query)
+        settings = [(a, _Canonical(getattr(self, a, None))) for a in REQUEST_SETTINGS]
+        return ('fsphinx', query, index, comment, tuple(settings))
+
+    def _Connect(self):
+        """Check out a connection from the pool if there is one attached.
+
+        Falls back to a new connection if the pool is exhausted.
+        """
+        if self.pool and not self._socket:
+            self._socket = self._pooled = self.pool.Get(self)
+        return SphinxClient._Connect(self)
+
+    def _Request(self, request, *args, **kwargs):
+        """Used internally to send a request to searchd with a SphinxClient
+        method, making sure a pooled connection is discarded if the request
+        failed before its response was read.
+        """
+        try:
+            return request(self, *args, **kwargs)
+        finally:
+            if self._pooled:
+                self.pool.Discard(self._pooled)
+                self._socket = self._pooled = None
+
+    def BuildExcerpts(self, *args, **kwargs):
+        return self._Request(SphinxClient.BuildExcerpts, *args, **kwargs)
+
+    def BuildKeywords(self, *args, **kwargs):
+        return self._Request(SphinxClient.BuildKeywords, *args, **kwargs)
+
+    def UpdateAttributes(self, *args, **kwargs):
+        return self._Request(SphinxClient.UpdateAttributes, *args, **kwargs)
+
+    def Status(self, *args, **kwargs):
+        return self._Request(SphinxClient.Status, *args, **kwargs)
+
+    def FlushAttributes(self, *args, **kwargs):
+        return self._Request(SphinxClient.FlushAttributes, *args, **kwargs)
+
+    def _GetResponse(self, sock, client_ver):
+        """Return the connection to the pool once the response has been read.
+        """
+        response = None
+        try:
+            response = SphinxClient._GetResponse(self, sock, client_ver)
+        finally:
+            if self._pooled:
+                if response is not None and self._socket is self._pooled:
+                    self.pool.Put(self._pooled)
+                else:
+                    self.pool.Discard(self._pooled)
+                self._socket = self._pooled = None
+        return response
+
+    def _QueryWithFacets(self, query, index, comment):
+        """Used internally to run the query and the facets all at once.
+
+        Returns the results of the query and the list of results of the facets.
+        """
+        if self._reqs:
+            raise RuntimeError('queries added with AddQuery have not been run')
+        self.AddQuery(query, index, comment)
+        self.facets._Prepare(query)
+        if not self.cache and self.facets.cache:
+            # the facets were given a cache of their own
+            try:
+                results = cache.CacheSphinx(self.facets.cache, self)
+            finally:
+                self._req_keys = []
+        else:
+            results = self.RunQueries()
+        self._reqs = []
+
+        # same error handling as SphinxClient.Query
+        if not results:
+            return None, []
+        self._error = results[0]['error']
+        self._warning = results[0]['warning']
+        if results[0]['status'] == sphinxapi.SEARCHD_ERROR:
+            return None, []
+        return results[0], results[1:]
+
     @classmethod
     def FromConfig(cls, path):
         """Creates a client from a config file.
@@ -153,7 +293,8 @@ class FSphinxClient(SphinxClient):
         cl = self.__class__()
 
         attrs = utils.save_attrs(self,
-            [a for a in self.__dict__ if a not in ['query', 'hits', 'facets', 'db_fetch', 'cache']])
+            [a for a in self.__dict__ if a not in ['query', 'hits', 'facets', 'db_fetch', 'cache',
+                                                  'pool', '_socket', '_pooled']])
         utils.load_attrs(cl, attrs)
 
         if self.db_fetch:
@@ -167,9 +308,23 @@ class FSphinxClient(SphinxClient):
                 f = Facet(f.name)
                 utils.load_attrs(f, attrs)
                 facets.append(f)
-            cl.AttachFacets(*facets)
+            cl.AttachFacets(*facets, batch_terms=self.facets.batch_terms)
 
         if self.cache:
             cl.AttachCache(self.cache)
 
+        if self.pool:
+            cl.AttachConnectionPool(self.pool)
+
         return cl
+
+
+def _Canonical(value):
+    """Used internally to have a representation of a setting independent of
+    the order of its dict items.
+    """
+    if isinstance(value, dict):
+        return tuple(sorted((k, _Canonical(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(_Canonical(v) for v in value)
+    return value
@@ -51,4 +51,26 @@ assert(facets.time == 0)
 
 # this makes sure the facet computation is not fetched from the cache
 facets.Compute('drama', caching=False)
-assert(facets.time > 0)
\ No newline at end of file
+assert(facets.time > 0)
+
+# keep the most popular facets deserialized in process in front of redis
+local_cache = LocalCache(cache, maxbytes=1024 * 1024, ttl=60)
+facets.AttachCache(local_cache)
+
+# the second computation is served without a round trip to redis
+facets.Compute('drama')
+facets.Compute('drama')
+assert(local_cache.hits > 0)
+
+# or share the facets between the processes of this host without redis at all
+mmap_cache = MMapCache('/tmp/fsphinx.cache', size=1024 * 1024 * 16)
+facets.AttachCache(mmap_cache)
+facets.Compute('drama')
+facets.Compute('drama')
+assert(facets.time == 0)
+
+# resolve the actor terms from memory instead of querying the db every time
+factor.SetTermDict(max_size=10000)
+facets.AttachCache(cache)
+facets.Compute('drama')
+assert(factor._term_dict._terms)
@@ -10,8 +10,7 @@ db_fetch = DBFetch(db, sql =
     where d.imdb_id = t.imdb_id) as directors
     from titles as t 
     where imdb_id in ($id)
-    order by field(imdb_id, $id)
-''')
+''', id_col='imdb_id')
 
 # let's perform a simple query
 results = cl.Query('movie')
@@ -23,4 +22,29 @@ hits = db_fetch.Fetch(results)
 print hits
 
 # make sure directors are returned as a list instead of as a concatenated string
-db_fetch.post_processors = [SplitOnSep('directors', sep='@#@')]
\ No newline at end of file
+db_fetch.post_processors = [SplitOnSep('directors', sep='@#@')]
+
+# keep the rows in process so the DB is only queried for the new ids
+db_fetch = DBFetch(db, sql=db_fetch._sql, id_col='imdb_id', row_cache=LocalCache(ttl=60))
+hits = db_fetch.Fetch(results)
+hits = db_fetch.Fetch(results)
+assert(db_fetch.row_hits == len(hits.matches))
+
+# or only fetch the hits from the DB once they are accessed
+db_fetch = DBFetch(db, sql=db_fetch._sql, id_col='imdb_id', lazy=True)
+hits = db_fetch.Fetch(results)
+print hits.ids, hits.total_found
+print hits.matches[0]['@hit']
+
+# split the fields in one pass over the hits and use threads on large pages
+from multiprocessing.pool import ThreadPool
+db_fetch = DBFetch(db, sql=db_fetch._sql, id_col='imdb_id', post_processors=[
+    Pipeline(SplitOnSep('directors'), pool=ThreadPool(4), min_pool=50)])
+hits = db_fetch.Fetch(results)
+
+# export the hits into a memory mapped document store and read them from there
+BuildDocStore('/tmp/titles.docs', db.query('select imdb_id, title, year, plot from titles'),
+              id_col='imdb_id')
+doc_store = DocStore('/tmp/titles.docs')
+hits = doc_store.Fetch(results)
+assert(not hits.missing)
@@ -0,0 +1,62 @@
+import os
+import sqlite3
+import tempfile
+import threading
+
+from fsphinx import *
+
+## Pooling Connections to the Database
+
+# let's have a small SQLite database instead of MySQL
+path = os.path.join(tempfile.mkdtemp(), 'fsphinx.db')
+conn = sqlite3.connect(path)
+conn.execute('create table titles (imdb_id integer primary key, title text, year integer)')
+conn.executemany('insert into titles values (?, ?, ?)',
+    [(1, 'The Matrix', 1999), (2, 'Blade Runner', 1982), (3, 'Brazil', 1985)])
+conn.commit()
+conn.close()
+
+# and a pool of up to 4 connections to it
+db = DBPool(sqlite3.connect, path, size=4, check_same_thread=False)
+
+# the pool is used as a database handle
+assert(db.query('select count(*) as n from titles')[0].n == 3)
+
+# the ids returned by Sphinx are passed to DBFetch queries as parameters
+db_fetch = DBFetch(db, sql='select imdb_id as id, title, year from titles where imdb_id in ($id)')
+
+# these are the results Sphinx would return
+results = dict(matches=[dict(id=i, weight=1, attrs={}) for i in (1, 3)])
+
+# fetching the hits
+hits = db_fetch.Fetch(results)
+assert([m['@hit'].title for m in hits] == ['The Matrix', 'Brazil'])
+
+# the connections are checked out by each thread and returned to the pool
+def Fetch():
+    for i in range(10):
+        db_fetch.Fetch(results)
+threads = [threading.Thread(target=Fetch) for i in range(8)]
+for t in threads: t.start()
+for t in threads: t.join()
+assert(len(db._idle) <= 4)
+
+# a thread may also hold on to a connection for all its queries
+db.Acquire()
+db.query('select * from titles')
+db.Release()
+
+# drivers with the named paramstyle get the parameters by name
+named = DBPool(sqlite3.connect, path, paramstyle='named', check_same_thread=False)
+assert(named.query('select title from titles where imdb_id = %s' % named.Marker(0), [2])[0].title == 'Blade Runner')
+
+# an idle connection is only checked when it is reused after check_idle seconds
+checked = []
+class CountingPool(DBPool):
+    def _IsAlive(self, conn):
+        checked.append(conn)
+        return DBPool._IsAlive(self, conn)
+counting = CountingPool(sqlite3.connect, path, check_idle=60, check_same_thread=False)
+counting.query('select 1')
+counting.query('select 1')
+assert(not checked)
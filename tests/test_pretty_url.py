@@ -22,4 +22,7 @@ print PrettyUrlToQuery(url, root='/search/')
 print QueryToPrettyUrl('movie', root='/search/')
 
 url = 'author=Arjan+Durresi/keyword=networks|systems/?ot=201'
-print PrettyUrlToQuery(url, root='/search/')
\ No newline at end of file
+print PrettyUrlToQuery(url, root='/search/')
+# the urls of many toggled or added terms at once, for example of facet values
+for url in BatchPrettyUrls(query, ['@genre drama', '@genre comedy', '@year 2000'], root='/search/'):
+    print url
@@ -48,4 +48,58 @@ cl.SetMatchMode(sphinxapi.SPH_MATCH_EXTENDED2)
 factor.Compute(query)
 
 # and looking at the results
-print factor
\ No newline at end of file
+print factor
+# parsing the same query again is served from the parse cache
+query = query_parser.Parse('@year 1999 @genre drama @actor harrison ford')
+assert(query_parser.hits == 1)
+
+# the cached query is not changed by toggling a term of the returned copy
+query['@genre drama'].Toggle()
+assert('(@genres drama)' in query_parser.Parse('@year 1999 @genre drama @actor harrison ford').sphinx)
+for query_term in query_parser.Parse('@year 1999 @genre drama @actor harrison ford'):
+    query_term.Toggle()
+assert('(@genres drama)' in query_parser.Parse('@year 1999 @genre drama @actor harrison ford').sphinx)
+
+# derived queries are made of copies of the terms of the query
+with_year = query + '@year 2000'
+toggled = query.GetQueryToggle('@actor harrison ford')
+assert('(@genres drama)' not in query.sphinx and '(@actors harrison ford)' in query.sphinx)
+assert('(@actors harrison ford)' not in toggled.sphinx and '(@year 2000)' in with_year.sphinx)
+
+# so toggling the terms of one query leaves the other intact
+for query_term in with_year:
+    query_term.ToggleOff()
+assert('(@actors harrison ford)' in query.sphinx and with_year.sphinx == ' ')
+
+# even a term held before the query was derived
+held = query['@actor harrison ford']
+with_year = query + '@year 2000'
+held.ToggleOff()
+assert('(@actors harrison ford)' in with_year.sphinx)
+held.ToggleOn()
+
+# terms are looked up by key and their sphinx strings are computed only once
+assert('@actor HARRISON FORD' in query)
+print query['@actor harrison ford'].sphinx
+
+# a term may also be changed in place and looked up by its new key
+query['@actor harrison ford'].term = 'brad pitt'
+assert('@actor brad pitt' in query and '@actor harrison ford' not in query)
+
+# queries can be pickled with any protocol, for example in a web.py session
+import pickle
+assert(pickle.loads(pickle.dumps(query, 0)).sphinx == query.sphinx)
+
+# the variants of a query may be rewritten to the same sphinx query
+query_parser = QueryParser(MultiFieldQuery, user_sph_map={'actor':'actors', 'genre':'genres'},
+                           rewriters=[DropNoopNegations(), CaseFold(), Dedupe(), SortTerms(), MergeFields()])
+query = query_parser.Parse('@genre Drama @-year 1999 @genre comedy drama')
+other = query_parser.Parse('@genre comedy drama @genre drama')
+assert(query.sphinx == other.sphinx and query.uniq == other.uniq)
+print query.sphinx
+
+# the operators of the extended syntax are not lowercased: '(@* secret MAYBE agent)'
+print query_parser.Parse('Secret MAYBE Agent').sphinx
+
+# nor are the terms with operators merged: '(@genres comedy MAYBE drama) (@genres drama)'
+print query_parser.Parse('@genre comedy MAYBE drama @genre drama').sphinx
@@ -8,8 +8,7 @@ db_fetch = DBFetch(db, sql =
     where d.imdb_id = t.imdb_id) as directors
     from titles as t 
     where imdb_id in ($id)
-    order by field(imdb_id, $id)
-''')
+''', id_col='imdb_id')
 
 # sql_table is optional and defaults to (facet_name)_terms
 fyear = Facet('year', sql_table=None)
@@ -51,6 +50,36 @@ cl.Query('movie')
 
 # or pass a MultiFieldQuery
 cl.Query(query)
+
+# send the query and all the facets to searchd in a single batch
+cl.SetBatchFacets()
+
+# only one round trip to searchd is performed
+cl.Query(query)
+
+# also fetch the terms of all the facets in one round trip to the db
+cl.facets.SetBatchTerms()
+cl.Query(query)
+
+# reuse persistent connections to searchd across clients
+cl.AttachConnectionPool(SphinxPool(size=5))
+
+# the clone and the facets check out connections from the same pool
+cl.Clone().Query(query)
+
+# cache the results using the canonical form of the queries
+cl.AttachCache(cache)
+cl.SetCanonicalKeys()
+
+# the same terms in a different order share the same cache entry
+cl.Query(query_parser.Parse('@genre drama @year 1999'))
+cl.Query(query_parser.Parse('@year 1999 @genre drama'))
+assert(cl.hits.time == 0)
+
+# build the excerpts of the plots in process instead of with searchd
+db_fetch._post_processors = [LocalExcerpts(cl, 'plot', limit=128, cache=LocalCache())]
+cl.Query('movie')
+print cl.hits.matches[0]['@hit']['plot_excerpts']
     
 ## Playing With Configuration Files
 
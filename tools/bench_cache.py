@@ -0,0 +1,122 @@
+#! /usr/bin/env python
+
+import sys
+import time
+import getopt
+
+import redis
+import simplejson as json
+
+from fsphinx import RedisCache, MMapCache
+
+
+class CountingConnection(redis.Connection):
+    """A redis connection which counts the number of round trips to the server.
+    """
+    round_trips = 0
+
+    def send_packed_command(self, command):
+        CountingConnection.round_trips += 1
+        redis.Connection.send_packed_command(self, command)
+
+
+def run(nb_reqs, nb_pages, mmap_file, opts):
+    if mmap_file:
+        # no redis server is needed and there are no round trips
+        cache = MMapCache(mmap_file)
+        pages = [('memory mapped', page_pipelined)]
+    else:
+        pool = redis.ConnectionPool(connection_class=CountingConnection, **opts)
+        cache = RedisCache(connection_pool=pool)
+        pages = [('one request at a time', page_per_request),
+                 ('pipelined', page_pipelined)]
+    cache.Flush()
+
+    print 'page of %s requests, %s pages' % (nb_reqs, nb_pages)
+    print
+    for name, page in pages:
+        # first pass fills the cache, second pass only reads from it
+        for step in ('miss', 'hit'):
+            CountingConnection.round_trips = 0
+            start = time.time()
+            for p in range(nb_pages):
+                page(cache, ['%s-%s-%s' % (name, p, i) for i in range(nb_reqs)])
+            elapsed = time.time() - start
+            print '%-22s %-4s: %6.2f round trips / page, %8.3f ms / page' % (
+                name, step, float(CountingConnection.round_trips) / nb_pages,
+                1000 * elapsed / nb_pages)
+        cache.Flush()
+
+
+def get_result(req):
+    return dict(status=0, error='', warning='', time='0.010', total=15, total_found=15,
+        fields=['title'], attrs=[['year_attr', 1]], words=[],
+        matches=[dict(id=i, weight=1, attrs={'@groupby': i, '@count': 10, '@groupfunc': 0.5})
+                 for i in range(15)])
+
+
+def page_per_request(cache, reqs):
+    # the requests as they were cached before MGET and pipelined SET
+    for req in reqs:
+        key = cache._MakeKey(req)
+        if cache.c.exists(key):
+            json.loads(cache.c.get(key))
+        else:
+            cache.c.set(key, json.dumps(get_result(req)))
+            cache.c.expire(key, cache.expire)
+
+
+def page_pipelined(cache, reqs):
+    results = cache.MGet(reqs)
+    cache.MSet([(req, get_result(req)) for req, result in zip(reqs, results) if result is None])
+
+
+def usage():
+    print 'Usage:'
+    print '    python bench_cache.py [options]'
+    print
+    print 'Description:'
+    print '    Compare the number of round trips to Redis when caching a page of requests.'
+    print '    Warning: the selected Redis database or memory mapped file is flushed.'
+    print
+    print 'Options:'
+    print '    -n, --nb_reqs <int>     : number of requests in a page (default is 6)'
+    print '    -p, --nb_pages <int>    : number of pages (default is 1000)'
+    print '    --host <host>           : redis host (default is localhost)'
+    print '    --port <int>            : redis port (default is 6379)'
+    print '    --db <int>              : redis database (default is 15)'
+    print '    --mmap <file>           : time a memory mapped cache in file instead of redis'
+    print '    -h, --help              : this help message'
+    print
+    print 'Email bugs/suggestions to Alex Ksikes (alex.ksikes@gmail.com)'
+
+
+def main():
+    try:
+        _opts, args = getopt.getopt(sys.argv[1:], 'n:p:h',
+            ['nb_reqs=', 'nb_pages=', 'host=', 'port=', 'db=', 'mmap=', 'help'])
+    except getopt.GetoptError:
+        usage(); sys.exit(2)
+
+    nb_reqs, nb_pages, mmap_file = 6, 1000, ''
+    opts = dict(host='localhost', port=6379, db=15)
+    for o, a in _opts:
+        if o in ('-n', '--nb_reqs'):
+            nb_reqs = int(a)
+        elif o in ('-p', '--nb_pages'):
+            nb_pages = int(a)
+        elif o == '--host':
+            opts['host'] = a
+        elif o == '--port':
+            opts['port'] = int(a)
+        elif o == '--db':
+            opts['db'] = int(a)
+        elif o == '--mmap':
+            mmap_file = a
+        elif o in ('-h', '--help'):
+            usage(); sys.exit()
+
+    run(nb_reqs, nb_pages, mmap_file, opts)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+#! /usr/bin/env python
+
+import sys
+import getopt
+
+from fsphinx import utils, BuildDocStore
+
+
+def run(to_file, sql, tsv, opts):
+    if sql:
+        db = utils.database(dbn='mysql', host=opts['host'], db=opts['db'],
+                            user=opts['user'], passwd=opts['passwd'])
+        rows = db.query(sql)
+    else:
+        rows = (dict(zip(opts['fields'], values))
+                for values in utils.iterfsep(tsv, sep=opts['tsv_sep']))
+    count = BuildDocStore(to_file, rows, opts['id_col'], opts['split'], opts['sep'])
+    print 'wrote %s records to %s' % (count, to_file)
+
+
+def usage():
+    print 'Usage:'
+    print '    python build_docstore.py [options] docstore_file'
+    print
+    print 'Description:'
+    print '    Export the hits from MySQL or from a TSV file into a document store read by DocStore.'
+    print
+    print 'Options:'
+    print '    --sql <query>           : SQL query returning the hits of all the documents'
+    print '    --db <name>             : MySQL database (default is fsphinx)'
+    print '    --host <host>           : MySQL host (default is localhost)'
+    print '    -u, --user <user>       : MySQL user (default is fsphinx)'
+    print '    -p, --passwd <passwd>   : MySQL password (default is fsphinx)'
+    print '    --tsv <file>            : read the hits from a TSV file instead'
+    print '    --fields <f1,f2,..>     : names of the columns of the TSV file'
+    print '    --tsv_sep <sep>         : separator of the TSV file (default is tab)'
+    print '    --id_col <name>         : name of the id column (default is id)'
+    print '    --split <f1,f2,..>      : multi-valued fields to split'
+    print '    --sep <sep>             : separator of the multi-valued fields (default is @#@)'
+    print '    -h, --help              : this help message'
+    print
+    print 'Email bugs/suggestions to Alex Ksikes (alex.ksikes@gmail.com)'
+
+
+def main():
+    try:
+        _opts, args = getopt.getopt(sys.argv[1:], 'u:p:h',
+            ['sql=', 'db=', 'host=', 'user=', 'passwd=', 'tsv=', 'fields=', 'tsv_sep=',
+             'id_col=', 'split=', 'sep=', 'help'])
+    except getopt.GetoptError:
+        usage(); sys.exit(2)
+
+    sql, tsv = '', ''
+    opts = dict(db='fsphinx', host='localhost', user='fsphinx', passwd='fsphinx',
+                fields=[], tsv_sep='\t', id_col='id', split=[], sep='@#@')
+    for o, a in _opts:
+        if o == '--sql':
+            sql = a
+        elif o == '--tsv':
+            tsv = a
+        elif o in ('--db', '--host', '--tsv_sep', '--id_col', '--sep'):
+            opts[o[2:]] = a
+        elif o in ('-u', '--user'):
+            opts['user'] = a
+        elif o in ('-p', '--passwd'):
+            opts['passwd'] = a
+        elif o in ('--fields', '--split'):
+            opts[o[2:]] = a.split(',')
+        elif o in ('-h', '--help'):
+            usage(); sys.exit()
+
+    if len(args) < 1 or not (sql or tsv) or (tsv and not opts['fields']):
+        usage()
+    else:
+        run(args[0], sql, tsv, opts)
+
+if __name__ == '__main__':
+    main()
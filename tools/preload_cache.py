@@ -6,16 +6,23 @@ import getopt
 from fsphinx import FSphinxClient
 
 
-def run(query, depth, flush, to_file, from_file, opts):
+def run(query, depth, flush, to_file, from_file, warm_up, opts):
     cl = get_sphinx_client(opts)
     if flush:
         cl.cache.Flush()
     if from_file:
-        cl.cache.Loads(from_file)
+        print 'loaded %s keys' % cl.cache.Loads(from_file, opts['expire'], progress=print_progress)
+    elif warm_up:
+        print 'warmed up %s requests' % cl.cache.WarmUp(cl, warm_up, opts['top'])
     else:
         preload_facets(query, depth, opts)
     if to_file:
-        cl.cache.Dumps(to_file)
+        print 'dumped %s keys' % cl.cache.Dumps(to_file, progress=print_progress)
+
+
+def print_progress(count):
+    sys.stdout.write('%s keys ...\r' % count)
+    sys.stdout.flush()
 
 
 def get_sphinx_client(opts):
@@ -25,7 +32,7 @@ def get_sphinx_client(opts):
     # wait for no more than chosen minute
     cl.SetConnectTimeout(opts['timeout'])
     # set the expire on all keys which will be inserted
-    cl.cache.expire = opts['expire']
+    cl.cache.expire = opts['expire'] or -1
 
     return cl
 
@@ -63,7 +70,10 @@ def usage():
     print '    -f, --flush                 : flush the cache beforehand'
     print '    --dump <tofile>             : also dump the results to a file'
     print '    --load <fromfile>           : load the results from a dumped file'
-    print '    --expire <int>              : expire flag on loaded keys in seconds (default -1 no expire)'
+    print '    --expire <int>              : expire flag on inserted keys in seconds (default -1 no expire)'
+    print '                                  loaded keys keep their dumped expire unless set'
+    print '    --warm_up <generation>      : re-run the most used requests of a previous index generation'
+    print '    --top <int>                 : number of requests to re-run (default is 1000)'
     print '    -h, --help                  : this help message'
     print
     print 'Email bugs/suggestions to Alex Ksikes (alex.ksikes@gmail.com)'
@@ -73,13 +83,13 @@ def main():
     try:
         _opts, args = getopt.getopt(sys.argv[1:], 'c:d:fh',
             ['conf=', 'depth=', 'flush', 'timeout=', 'dump=', 'load=',
-             'expire=', 'help'])
+             'expire=', 'warm_up=', 'top=', 'help'])
     except getopt.GetoptError:
         usage(); sys.exit(2)
 
     query, depth, flush = args and args[0], 1, False
-    to_file, from_file = '', ''
-    opts = dict(conf='sphinx_config.py', timeout=60.0, expire=-1)
+    to_file, from_file, warm_up = '', '', ''
+    opts = dict(conf='sphinx_config.py', timeout=60.0, expire=None, top=1000)
     for o, a in _opts:
         if o in ('-q', '--query'):
             query = a
@@ -97,13 +107,17 @@ def main():
             from_file = a
         elif o in ('--expire'):
             opts['expire'] = int(a)
+        elif o == '--warm_up':
+            warm_up = a
+        elif o == '--top':
+            opts['top'] = int(a)
         elif o in ('-h', '--help'):
             usage(); sys.exit()
 
-    if len(args) < 1:
+    if len(args) < 1 and not warm_up:
         usage()
     else:
-        run(query, depth, flush, to_file, from_file, opts)
+        run(query, depth, flush, to_file, from_file, warm_up, opts)
 
 if __name__ == '__main__':
     main()
@@ -44,8 +44,7 @@ select
     (select group_concat(distinct genre separator '@#@') from genres as g where g.imdb_id = t.imdb_id) as genre, 
     (select group_concat(distinct plot_keyword separator '@#@') from plot_keywords as p where p.imdb_id = t.imdb_id) as keyword 
 from titles as t 
-where imdb_id in ($id)
-order by field(imdb_id, $id)''', post_processors = [
+where imdb_id in ($id)''', post_processors = [
     SplitOnSep('director', 'actor', 'genre', 'keyword', sep='@#@')
 ]
 )
@@ -120,8 +120,7 @@ db_fetch = DBFetch(db, sql =
     where d.imdb_id = t.imdb_id) as directors
     from titles as t 
     where imdb_id in ($id)
-    order by field(imdb_id, $id)
-''')
+''', id_col='imdb_id')
 
 # let's perform a simple query
 results = cl.Query('movie')